@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmarks for nsmclient against a local stand-in NSM server.
+
+The stand-in server is a minimal pure-Python OSC server listening on a UDP
+port on localhost. It answers announce messages with a welcome reply and can
+send open and save requests to the client and wait for the client's reply.
+No real nsmd is required.
+
+Results are written as JSON to standard output or to the file given with the
+``-o`` option, so that results from different commits can be compared.
+
+Usage::
+
+    python benchmark.py [-b {liblo,udp}] [-n ITERATIONS] [-o results.json]
+
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+import nsmclient
+from nsmclient import (CAP_DIRTY, CAP_MESSAGE, CAP_PROGRESS, MSG_ANNOUNCE,
+                       MSG_OPEN, MSG_REPLY, MSG_SAVE, NSMClient,
+                       encode_osc_message, iter_osc_packet)
+
+
+log = logging.getLogger("nsmbench")
+
+
+class StandInNSMServer(object):
+    """Minimal NSM server stand-in using a UDP socket on localhost."""
+
+    def __init__(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Buffer bursts of messages sent by the throughput benchmarks
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        self.socket.bind(('127.0.0.1', 0))
+        self.url = "osc.udp://127.0.0.1:%i/" % self.socket.getsockname()[1]
+        self.client_addr = None
+        self.received = 0
+        self._replies = {}
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                data, addr = self.socket.recvfrom(65536)
+            except OSError:
+                break
+
+            # The client sends some messages together in one bundle
+            with self._cond:
+                for path, args, types in iter_osc_packet(data):
+                    self.received += 1
+
+                    if path == MSG_ANNOUNCE:
+                        self.client_addr = addr
+                        self.socket.sendto(
+                            encode_osc_message(MSG_REPLY, MSG_ANNOUNCE,
+                                               "Welcome", "Stand-in NSM",
+                                               ":optional-gui:"),
+                            addr)
+                    elif path == MSG_REPLY and args:
+                        self._replies[args[0]] = (
+                            self._replies.get(args[0], 0) + 1)
+
+                self._cond.notify_all()
+
+    def request(self, path, *args, timeout=5):
+        """Send a request to the client and wait for the matching reply."""
+        with self._cond:
+            count = self._replies.get(path, 0)
+            self.socket.sendto(encode_osc_message(path, *args),
+                               self.client_addr)
+
+            if not self._cond.wait_for(
+                    lambda: self._replies.get(path, 0) > count, timeout):
+                raise RuntimeError("No reply to %s from client." % path)
+
+    def wait_received(self, count, timeout=5):
+        """Wait until the server has received ``count`` messages in total."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self.received >= count,
+                                       timeout)
+
+    def close(self):
+        self.socket.close()
+
+
+class BenchmarkClient(NSMClient):
+    @property
+    def capabilities(self):
+        return (CAP_DIRTY, CAP_MESSAGE, CAP_PROGRESS)
+
+    def open_session(self, session_prefix, session_name, client_id):
+        return "/bench.dat"
+
+    def save_session(self, session_path):
+        pass
+
+
+def summarize(samples):
+    """Return summary statistics (in seconds) for a list of timings."""
+    samples = sorted(samples)
+    return {
+        'n': len(samples),
+        'min': samples[0],
+        'median': statistics.median(samples),
+        'mean': statistics.mean(samples),
+        'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        'max': samples[-1],
+    }
+
+
+def stop_client(client):
+    client.osc_server.stop()
+    client.osc_server.free()
+
+
+def bench_announce(backend, iterations):
+    """Measure announce-to-welcome latency of NSMClient.init()."""
+    samples = []
+
+    for i in range(iterations):
+        client = BenchmarkClient(init=False, backend=backend)
+        try:
+            samples.append(client.init(executable="nsmbench"))
+        finally:
+            stop_client(client)
+
+    return summarize(samples)
+
+
+def bench_roundtrip(server, client, iterations):
+    """Measure open and save round-trip time through the client handlers."""
+    results = {}
+
+    for name, path, args in (
+            ('open', MSG_OPEN, ("/tmp/nsmbench", "nsmbench", "nBENCH")),
+            ('save', MSG_SAVE, ())):
+        samples = []
+
+        for i in range(iterations):
+            start = time.perf_counter()
+            server.request(path, *args)
+            samples.append(time.perf_counter() - start)
+
+        results[name] = summarize(samples)
+
+    return results
+
+
+def bench_send(server, client, iterations):
+    """Measure outbound message throughput and CPU time per message.
+
+    Messages are sent synchronously by the calling thread, so only its CPU
+    time is measured, not that of the stand-in server's receive thread.
+    Messages not received by the server within the timeout are reported as
+    ``lost``.
+
+    """
+    results = {}
+
+    for name, func in (
+            ('send_message', lambda i: client.send_message("Status", 1)),
+            ('update_progress', lambda i: client.update_progress(i / 1000.)),
+            ('set_dirty', lambda i: client.set_dirty(i % 2 == 0))):
+        expected = server.received + iterations
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+
+        for i in range(iterations):
+            func(i)
+
+        cpu = time.thread_time() - cpu
+        wall = time.perf_counter() - wall
+        lost = 0
+
+        if not server.wait_received(expected):
+            lost = expected - server.received
+            log.warning("%s: %i of %i messages not received by server.",
+                        name, lost, iterations)
+
+        results[name] = {
+            'messages': iterations,
+            'messages_per_sec': iterations / wall,
+            'cpu_per_message': cpu / iterations,
+            'lost': lost,
+        }
+
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(args=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('-b', '--backend',
+                    choices=(nsmclient.BACKEND_LIBLO, nsmclient.BACKEND_UDP),
+                    help="OSC backend to benchmark (default: auto)")
+    ap.add_argument('-n', '--iterations', type=int, default=100,
+                    help="Number of iterations for latency benchmarks "
+                    "(default: %(default)s)")
+    ap.add_argument('-m', '--messages', type=int, default=10000,
+                    help="Number of messages for throughput benchmarks "
+                    "(default: %(default)s)")
+    ap.add_argument('-o', '--output', metavar='FILE',
+                    help="Write JSON results to FILE (default: stdout)")
+    ap.add_argument('-v', '--verbose', action='store_true',
+                    help="Enable debug logging")
+    args = ap.parse_args(args)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else
+                        logging.WARNING)
+
+    server = StandInNSMServer()
+    os.environ['NSM_URL'] = server.url
+    client = None
+
+    try:
+        backend = nsmclient._select_backend(args.backend)
+        results = {
+            'revision': git_revision(),
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'backend': backend,
+            'announce': bench_announce(backend, args.iterations),
+        }
+        client = BenchmarkClient(backend=backend, executable="nsmbench")
+        results['roundtrip'] = bench_roundtrip(server, client,
+                                               args.iterations)
+        results['send'] = bench_send(server, client, args.messages)
+    finally:
+        if client is not None:
+            stop_client(client)
+
+        server.close()
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    sys.exit(main() or 0)
@@ -0,0 +1,6 @@
+"""pytest configuration.
+
+Its presence makes pytest put the source directory on ``sys.path``, so the
+tests can import ``nsmclient`` without installing it first.
+
+"""
@@ -29,18 +29,35 @@ usage instructions.
 """
 
 import abc
+import cProfile
 import logging
 import os
+import re
+import select
+import socket
+import struct
 import sys
+import tempfile
+import threading
 import time
+import tracemalloc
 
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from enum import Enum
+from functools import lru_cache, partial
+from itertools import count
 from os.path import abspath, basename, dirname, join
 from signal import signal, SIGTERM
 
-# You need pyliblo for Python 3 for nsmclient and of course an installed and
-# running non-session-manager
-import liblo
+# pyliblo for Python 3 is optional. Without it, the built-in pure-Python UDP
+# OSC backend is used. You will of course need an installed and running
+# non-session-manager.
+# pyliblo is only imported when a client joins a session (see _import_liblo).
+liblo = None
 
 
 log = logging.getLogger(__name__)
@@ -79,6 +96,22 @@ CAP_OPTIONAL_GUI = "optional-gui"
 # restarting
 CAP_SWITCH = "switch"
 
+# Keys of NSMClient.save_stats
+SAVE_STATS_KEYS = ('saved', 'failed', 'skipped_clean', 'skipped_unchanged',
+                   'coalesced')
+# Path under which messages without a handler are counted in the metrics
+_UNKNOWN_PATH = '*'
+
+# OSC transport backends
+# liblo.ServerThread / liblo.Server (requires pyliblo)
+BACKEND_LIBLO = "liblo"
+# built-in pure-Python UDP OSC implementation
+BACKEND_UDP = "udp"
+
+# Direction of messages in trace files
+TRACE_IN = 0
+TRACE_OUT = 1
+
 
 class ErrCode(Enum):
     """NSM protocol error codes."""
@@ -108,114 +141,2530 @@ class ErrCode(Enum):
     OPERATION_PENDING = -12
 
 
-class ClientState(object):
-    """Simple data class to store NSM client state."""
+class NSMError(Exception):
+    """Exception carrying the ``ErrCode`` to report to the NSM server.
 
-    def __init__(self, url):
-        # NSM reported the session is loaded
-        # set by NSMClient.session_loaded()
-        self.session_loaded = False
-        # NSM_URL environment variable
-        # set by NSMClient.init()
-        self.nsm_url = url
-        # set by NSMClient.handle_welcome()
-        self.session_joined = False
-        self.welcome_msg = None
-        self.nsm_name = None
-        # Test for a server capability with:
-        # capability in self.server_capabilities
-        self.server_capabilities = set()
-        # set by NSMClient.handle_open()
-        self.session_prefix = None
-        self.session_path = None
-        self.session_name = None
-        self.client_id = None
-        # Everything is clean and shiny in the beginning.
-        self.dirty = False
+    May be raised by ``open_session`` and ``save_session`` to choose the
+    error code of the error reply sent to the server.
+
+    """
+
+    def __init__(self, msg, code=ErrCode.GENERAL):
+        super().__init__(msg)
+        self.code = code
+
+
+class OperationCancelled(NSMError):
+    """Raised by ``CancellationToken.check`` when an open was superseded."""
+
+    def __init__(self, msg="Superseded by a newer open request."):
+        super().__init__(msg, ErrCode.OPERATION_PENDING)
+
+
+class CancellationToken(object):
+    """Cooperative cancellation flag for open operations.
+
+    Passed to ``open_session`` as the ``cancel`` keyword argument, if it
+    accepts one. The token is cancelled, when a newer open request is received
+    while the operation is running. A long-running ``open_session`` should
+    then call ``check`` regularly, which raises ``OperationCancelled``, to stop
+    loading a session, which is not needed anymore.
+
+    Tokens can be pickled, e.g. to pass them to a ``ProcessPoolExecutor``, but
+    the copy is a new token, which is never cancelled.
+
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def __reduce__(self):
+        # Cancellation can not be signalled to other processes
+        return (self.__class__, ())
+
+    @property
+    def cancelled(self):
+        """Whether the operation has been cancelled."""
+        return self._event.is_set()
+
+    def cancel(self):
+        """Request cancellation of the operation."""
+        self._event.set()
+
+    def check(self):
+        """Raise ``OperationCancelled`` if the operation has been cancelled."""
+        if self._event.is_set():
+            raise OperationCancelled()
+
+
+# Pure-Python OSC implementation
+
+def _osc_pad(data):
+    """Return data null-terminated and padded to a multiple of four bytes."""
+    return data + b"\0" * (4 - len(data) % 4)
+
+
+def _osc_string(value):
+    return _osc_pad(value.encode('utf-8'))
+
+
+def _osc_blob(value):
+    value = bytes(value)
+    size = len(value)
+    return struct.pack('>i', size) + value + b"\0" * (-size % 4)
+
+
+_OSC_ENCODERS = {
+    'i': struct.Struct('>i').pack,
+    'h': struct.Struct('>q').pack,
+    'f': struct.Struct('>f').pack,
+    'd': struct.Struct('>d').pack,
+    't': struct.Struct('>Q').pack,
+    'c': lambda v: struct.pack('>i', ord(v)),
+    's': _osc_string,
+    'S': _osc_string,
+    'b': _osc_blob,
+    'T': lambda v: b"",
+    'F': lambda v: b"",
+    'N': lambda v: b"",
+    'I': lambda v: b"",
+}
+# Argument types, which can be packed with a single struct format
+_OSC_STRUCT_FORMATS = {'i': 'i', 'h': 'q', 'f': 'f', 'd': 'd', 't': 'Q'}
+
+
+def _osc_typetag(value):
+    """Return OSC type tag for a Python value."""
+    if value is True:
+        return 'T'
+    elif value is False:
+        return 'F'
+    elif value is None:
+        return 'N'
+    elif isinstance(value, int):
+        return 'i' if -0x80000000 <= value <= 0x7FFFFFFF else 'h'
+    elif isinstance(value, float):
+        return 'f'
+    elif isinstance(value, str):
+        return 's'
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        return 'b'
+
+    raise TypeError("Unsupported OSC argument type: %r" % type(value))
+
+
+class OSCMessageTemplate(object):
+    """Pre-built encoder for OSC messages with a fixed path and type tags.
+
+    The path and the type tag string are encoded once on creation. Messages
+    with only numeric arguments are packed with a single pre-compiled
+    ``struct.Struct``, messages without arguments are a constant byte string.
+
+    """
+
+    __slots__ = ('path', 'typetags', 'prefix', 'encoders', 'packer')
+
+    def __init__(self, path, typetags=""):
+        self.path = path
+        self.typetags = typetags
+        self.prefix = _osc_string(path) + _osc_string("," + typetags)
+        self.encoders = tuple(_OSC_ENCODERS[t] for t in typetags)
+
+        if typetags and all(t in _OSC_STRUCT_FORMATS for t in typetags):
+            self.packer = struct.Struct(
+                '>' + "".join(_OSC_STRUCT_FORMATS[t] for t in typetags)).pack
+        else:
+            self.packer = None
+
+    def encode(self, *args):
+        """Return OSC message with given argument values as bytes."""
+        if self.packer is not None:
+            return self.prefix + self.packer(*args)
+        elif not self.encoders:
+            return self.prefix
+
+        return self.prefix + b"".join(
+            [enc(arg) for enc, arg in zip(self.encoders, args)])
+
+
+# Templates for the messages sent by NSM clients
+_OSC_TEMPLATES = {
+    (path, typetags): OSCMessageTemplate(path, typetags)
+    for path, typetags in (
+        (MSG_ANNOUNCE, "sssiii"),
+        (MSG_REPLY, "ss"),
+        (MSG_ERROR, "sis"),
+        (MSG_PROGRESS, "f"),
+        (MSG_MESSAGE, "is"),
+        (MSG_LABEL, "s"),
+        (MSG_DIRTY, ""),
+        (MSG_CLEAN, ""),
+        (MSG_GUI_SHOWN, ""),
+        (MSG_GUI_HIDDEN, ""),
+    )
+}
+
+
+def encode_osc_message(path, *args, cache=True):
+    """Encode an OSC message and return it as bytes.
+
+    Arguments may be given as plain Python values (``int``, ``float``,
+    ``str``, ``bytes``, ``bool`` or ``None``), as ``(typetag, value)`` tuples
+    or as ``Enum`` members with one of these types as value.
+
+    The template built for the path and type tags is kept for later messages,
+    unless ``cache`` is ``False``, which should be used for messages with
+    arbitrary paths, e.g. received from other applications.
+
+    """
+    values = []
+    typetags = []
+
+    for arg in args:
+        if isinstance(arg, tuple):
+            typetag, arg = arg
+        else:
+            if isinstance(arg, Enum):
+                arg = arg.value
+            typetag = _osc_typetag(arg)
+
+        typetags.append(typetag)
+        values.append(arg)
+
+    key = (path, "".join(typetags))
+    template = _OSC_TEMPLATES.get(key)
+
+    if template is None:
+        template = OSCMessageTemplate(*key)
+
+        if cache:
+            _OSC_TEMPLATES[key] = template
+
+    return template.encode(*values)
+
+
+def encode_osc_bundle(messages):
+    """Encode a sequence of messages as an OSC bundle and return bytes.
+
+    Each message is a tuple ``(path, arg1, arg2, ...)``. The bundle has the
+    time tag "immediately".
+
+    """
+    parts = [b"#bundle\0", struct.pack('>Q', 1)]
+
+    for msg in messages:
+        data = encode_osc_message(*msg)
+        parts.append(struct.pack('>i', len(data)))
+        parts.append(data)
+
+    return b"".join(parts)
+
+
+def _osc_read_string(data, offset):
+    end = data.index(b"\0", offset)
+    return data[offset:end].decode('utf-8', 'replace'), (end + 4) & ~3
+
+
+def decode_osc_message(data):
+    """Decode OSC message bytes and return (path, args, typetags) tuple."""
+    path, offset = _osc_read_string(data, 0)
+
+    if offset >= len(data):
+        # Message without a type tag string
+        return path, [], ""
+
+    typetags, offset = _osc_read_string(data, offset)
+
+    if not typetags.startswith(','):
+        raise ValueError("Malformed OSC type tag string: %r" % typetags)
+
+    typetags = typetags[1:]
+    args = []
+
+    for typetag in typetags:
+        if typetag in _OSC_STRUCT_FORMATS:
+            fmt = '>' + _OSC_STRUCT_FORMATS[typetag]
+            args.append(struct.unpack_from(fmt, data, offset)[0])
+            offset += struct.calcsize(fmt)
+        elif typetag in 'sS':
+            value, offset = _osc_read_string(data, offset)
+            args.append(value)
+        elif typetag == 'b':
+            size = struct.unpack_from('>i', data, offset)[0]
+            offset += 4
+            args.append(data[offset:offset + size])
+            offset += size + (-size % 4)
+        elif typetag == 'c':
+            args.append(chr(struct.unpack_from('>i', data, offset)[0]))
+            offset += 4
+        elif typetag == 'T':
+            args.append(True)
+        elif typetag == 'F':
+            args.append(False)
+        elif typetag == 'N':
+            args.append(None)
+        elif typetag == 'I':
+            args.append(float('inf'))
+        else:
+            raise ValueError("Unsupported OSC type tag: %r" % typetag)
+
+    return path, args, typetags
+
+
+def iter_osc_packet(data):
+    """Yield (path, args, typetags) for each message in an OSC packet.
+
+    Bundles are unpacked recursively. Bundle time tags are ignored and the
+    contained messages are delivered immediately.
+
+    """
+    if data.startswith(b"#bundle\0"):
+        offset = 16
+
+        while offset + 4 <= len(data):
+            size = struct.unpack_from('>i', data, offset)[0]
+            offset += 4
+            yield from iter_osc_packet(data[offset:offset + size])
+            offset += size
+    else:
+        yield decode_osc_message(data)
+
+
+_OSC_URL_RX = re.compile(r'^osc\.udp://\[?([^\]/]*?)\]?:(\d+)/?$')
+
+
+class OSCAddress(object):
+    """Address of an OSC peer, compatible with the subset of ``liblo.Address``
+    used by this module."""
+
+    __slots__ = ('hostname', 'port', 'sockaddr')
+
+    def __init__(self, hostname, port, sockaddr=None):
+        self.hostname = hostname
+        self.port = int(port)
+
+        if sockaddr is None:
+            info = socket.getaddrinfo(hostname or None, self.port,
+                                      socket.AF_INET, socket.SOCK_DGRAM)
+            sockaddr = info[0][4]
+
+        self.sockaddr = sockaddr
+
+    @classmethod
+    def from_url(cls, url):
+        match = _OSC_URL_RX.match(url)
+
+        if not match:
+            raise ValueError("Unsupported OSC URL: %r" % url)
+
+        return cls(*match.groups())
+
+    @property
+    def url(self):
+        return "osc.udp://%s:%i/" % (self.hostname, self.port)
+
+    def get_url(self):
+        return self.url
+
+
+# Code object flags set for functions with a *args parameter and for
+# coroutine functions (``async def``)
+_CO_VARARGS = 0x04
+_CO_COROUTINE = 0x80
+
+
+def _callback_nargs(callback):
+    """Return number of arguments to pass to an OSC method callback."""
+    func = getattr(callback, '__func__', callback)
+    code = getattr(func, '__code__', None)
+
+    if code is None or code.co_flags & _CO_VARARGS:
+        return 4
+
+    return code.co_argcount - (1 if hasattr(callback, '__self__') else 0)
+
+
+def _iscoroutinefunction(func):
+    """Return whether func is defined with ``async def``."""
+    func = getattr(func, '__func__', func)
+    code = getattr(func, '__code__', None)
+    return code is not None and bool(code.co_flags & _CO_COROUTINE)
+
+
+def _isawaitable(obj):
+    """Return whether obj can be used in an ``await`` expression."""
+    return hasattr(obj, '__await__')
+
+
+class OSCServer(object):
+    """Minimal OSC server and client using a UDP socket.
+
+    Implements the subset of the ``liblo.Server`` interface used by
+    ``NSMClient``. Incoming messages are only processed when the ``recv``
+    method is called. See ``OSCServerThread`` for a threaded variant.
+
+    Like with liblo, callbacks registered with ``add_method`` are called with
+    as many of the arguments ``path``, ``args``, ``types`` and ``src`` as
+    their signature accepts.
+
+    """
+
+    def __init__(self, port=0, host=''):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((host, port))
+        self.port = self.socket.getsockname()[1]
+        self.url = "osc.udp://%s:%i/" % (socket.gethostname(), self.port)
+        self._methods = {}
+        self._fallback = []
+        self._targets = {}
+
+    def add_method(self, path, typespec, callback):
+        """Register callback for messages matching path and type spec.
+
+        If ``path`` or ``typespec`` is ``None``, the method matches any path
+        or any argument types respectively.
+
+        """
+        entry = (typespec, callback, _callback_nargs(callback))
+
+        if path is None:
+            self._fallback.append(entry)
+        else:
+            self._methods.setdefault(path, []).append(entry)
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def free(self):
+        self.socket.close()
+
+    def recv(self, timeout=None):
+        """Wait for and dispatch one incoming OSC packet.
+
+        ``timeout`` is given in milliseconds, like for ``liblo.Server.recv``.
+        ``None`` means to block until a packet is received.
+
+        Returns ``True`` if a packet was received, ``False`` otherwise.
+
+        """
+        if timeout is not None:
+            ready = select.select([self.socket], [], [], timeout / 1000.)[0]
+
+            if not ready:
+                return False
+
+        try:
+            data, addr = self.socket.recvfrom(65536)
+        except (BlockingIOError, InterruptedError):
+            return False
+
+        self.dispatch(data, addr)
+        return True
+
+    def dispatch(self, data, addr):
+        """Decode an OSC packet and call the matching registered methods."""
+        src = OSCAddress(addr[0], addr[1], addr)
+
+        try:
+            messages = list(iter_osc_packet(data))
+        except (ValueError, IndexError, struct.error) as exc:
+            log.warning("Received malformed OSC packet from '%s': %s",
+                        src.url, exc)
+            return
+
+        for path, args, types in messages:
+            for typespec, callback, nargs in (self._methods.get(path, []) +
+                                              self._fallback):
+                if typespec is None or typespec == types:
+                    try:
+                        callback(*(path, args, types, src)[:nargs])
+                    except Exception:
+                        log.exception("Error in OSC method callback for '%s'.",
+                                      path)
+                    break
+
+    def send(self, target, path, *args):
+        """Send an OSC message to the given target.
+
+        ``target`` may be an OSC URL, an ``OSCAddress`` or a ``liblo.Address``
+        like object with ``hostname`` and ``port`` attributes.
+
+        """
+        self.socket.sendto(encode_osc_message(path, *args),
+                           self._resolve(target))
+
+    def send_bundle(self, target, messages):
+        """Send messages as one OSC bundle to the given target.
+
+        Each message is a tuple ``(path, arg1, arg2, ...)``.
+
+        """
+        self.socket.sendto(encode_osc_bundle(messages), self._resolve(target))
+
+    def _resolve(self, target):
+        try:
+            return self._targets[target]
+        except (KeyError, TypeError):
+            pass
+
+        if isinstance(target, str):
+            sockaddr = self._targets[target] = OSCAddress.from_url(
+                target).sockaddr
+        elif isinstance(target, OSCAddress):
+            sockaddr = target.sockaddr
+        else:
+            sockaddr = OSCAddress(target.hostname, target.port).sockaddr
+
+        return sockaddr
+
+
+class OSCServerThread(OSCServer):
+    """OSC server processing incoming messages in a background thread.
+
+    Implements the subset of the ``liblo.ServerThread`` interface used by
+    ``NSMClient``.
+
+    """
+
+    def __init__(self, port=0, host=''):
+        super().__init__(port, host)
+        self._thread = None
+        self._wakeup = None
+
+    def start(self):
+        """Start the server thread."""
+        self._wakeup = socket.socketpair()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name="OSCServerThread")
+        self._thread.start()
+
+    def stop(self):
+        """Stop the server thread and wait for it to finish."""
+        if self._thread is not None:
+            self._wakeup[1].send(b"\0")
+
+            if self._thread is not threading.current_thread():
+                self._thread.join()
+
+            self._thread = None
+
+    def free(self):
+        self.stop()
+        super().free()
+
+    def _run(self):
+        wakeup = self._wakeup[0]
+
+        try:
+            while True:
+                ready = select.select([self.socket, wakeup], [], [])[0]
+
+                if wakeup in ready:
+                    break
+
+                self.recv(0)
+        finally:
+            for sock in self._wakeup:
+                sock.close()
+
+
+def _import_liblo():
+    """Import pyliblo on first use and return the module."""
+    global liblo
+
+    if liblo is None:
+        import liblo as module
+        liblo = module
+
+    return liblo
+
+
+def _select_backend(backend=None):
+    """Return name of OSC backend to use, checking its availability.
+
+    Imports pyliblo, if the liblo backend is requested or no backend is given.
+
+    """
+    if backend not in (None, BACKEND_LIBLO, BACKEND_UDP):
+        raise ValueError("Unknown OSC backend: %r" % backend)
+    elif backend == BACKEND_UDP:
+        return backend
+
+    try:
+        _import_liblo()
+    except ImportError:
+        if backend == BACKEND_LIBLO:
+            raise RuntimeError("The 'liblo' OSC backend requires pyliblo.")
+
+        return BACKEND_UDP
+
+    return BACKEND_LIBLO
+
+
+@lru_cache(maxsize=8)
+def _executable_name(filename, path, cwd):
+    """Return the executable name of the program to report to NSM.
+
+    If the directory of the main script is in ``PATH``, the base name of the
+    script is returned, otherwise its absolute path.
+
+    """
+    if dirname(filename) in path.split(os.pathsep):
+        return basename(filename)
+
+    return abspath(join(cwd, filename))
+
+
+class ProgressReporter(object):
+    """Report progress of an operation to the NSM server with throttling.
+
+    Instances are created with ``NSMClient.progress``. Progress can be
+    reported as a fraction between 0.0 and 1.0 with ``update``, in work units
+    with ``advance``, if the total number of work units is known, or by
+    iterating over the reporter, if it wraps an iterable. For iterables
+    without a length and no given ``total``, progress is only reported when
+    the iteration is complete.
+
+    Updates are coalesced: a ``/nsm/client/progress`` message is only sent if
+    at least ``interval`` seconds have passed since the last message *and* the
+    progress has increased by at least ``min_delta`` since then. The final
+    value 1.0 is always sent, when ``finish`` is called or the ``with`` block
+    using the reporter as a context manager is left without an exception.
+
+    ``subtask`` returns a child reporter, which maps its own 0.0 - 1.0 range
+    onto the next ``weight`` fraction of its parent's range. Updates of child
+    reporters are passed on to the top-level reporter, which does the
+    throttling.
+
+    Example::
+
+        def open_session(self, session_prefix, session_name, client_id):
+            with self.progress() as progress:
+                with progress.subtask(0.2, iterable=files) as files:
+                    for filename in files:
+                        load_file(filename)
+
+                for track in progress.subtask(0.8, iterable=tracks):
+                    track.load()
+
+    """
+
+    _enabled = False
+
+    def __init__(self, client, total=None, iterable=None, interval=0.1,
+                 min_delta=0.01):
+        if total is None and iterable is not None:
+            try:
+                total = len(iterable)
+            except TypeError:
+                pass
+
+        self.total = total
+        self.iterable = iterable
+        self.completed = 0
+        self.value = 0.0
+        self._allocated = 0.0
+        self._client = client
+        self.interval = interval
+        self.min_delta = min_delta
+        self._last_sent = None
+        self._last_time = 0.0
+
+        if client is not None:
+            self._enabled = client._has_capability(CAP_PROGRESS)
+
+            if not self._enabled:
+                log.warning("Progress reporter created, but the client was "
+                            "not initialized with the 'progress' capability. "
+                            "No progress updates will be sent.")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.finish()
+
+    def __iter__(self):
+        if self.iterable is None:
+            raise TypeError("Progress reporter does not wrap an iterable.")
+
+        # Without a known length, progress can only be reported at the end
+        total = self.total
+
+        for item in self.iterable:
+            yield item
+
+            if total:
+                self.advance()
+
+        self.finish()
+
+    def advance(self, units=1):
+        """Mark given number of work units as completed."""
+        if not self.total:
+            raise ValueError("Total number of work units is not known.")
+
+        self.completed += units
+        self.update(self.completed / self.total)
+
+    def update(self, value):
+        """Set progress of this (sub-)task to value between 0.0 and 1.0."""
+        self._set_value(min(max(float(value), 0.0), 1.0))
+
+    def finish(self):
+        """Mark task as completed and send the final progress value 1.0."""
+        self.value = 1.0
+        self._send(1.0)
+
+    def subtask(self, weight, total=None, iterable=None):
+        """Return reporter for a sub-task using ``weight`` of this range.
+
+        Sub-tasks are allocated one after another, starting from the current
+        progress of this reporter. When a sub-task finishes, the progress of
+        this reporter is set to the end of the sub-task's range.
+
+        """
+        start = max(self.value, self._allocated)
+        weight = min(weight, 1.0 - start)
+        self._allocated = start + weight
+        return _ProgressSubtask(self, start, weight, total, iterable)
+
+    def _set_value(self, value):
+        self.value = value
+
+        if value >= 1.0:
+            self._send(1.0)
+            return
+
+        now = time.monotonic()
+
+        if (value - (self._last_sent or 0.0) >= self.min_delta and
+                now - self._last_time >= self.interval):
+            self._send(value, now)
+
+    def _send(self, value, now=None):
+        if self._last_sent is not None and value <= self._last_sent:
+            return
+
+        self._last_sent = value
+        self._last_time = time.monotonic() if now is None else now
+
+        if self._enabled:
+            self._client.send(MSG_PROGRESS, float(value))
+
+
+class _ProgressSubtask(ProgressReporter):
+    """Reporter for a sub-task of a ``ProgressReporter``."""
+
+    def __init__(self, parent, start, weight, total=None, iterable=None):
+        super().__init__(None, total, iterable)
+        self._parent = parent
+        self._start = start
+        self._weight = weight
+
+    def _set_value(self, value):
+        self.value = value
+        self._parent._set_value(self._start + value * self._weight)
+
+    def finish(self):
+        """Mark sub-task as completed."""
+        self._set_value(1.0)
+
+
+class DeferredOpen(object):
+    """Return value of ``open_session`` to finish loading in the background.
+
+    ``session_path`` is the session path (or suffix), as normally returned by
+    ``open_session``. ``load`` is a callable, which is passed a
+    ``ProgressReporter`` and loads the remaining, non-essential parts of the
+    session.
+
+    When ``open_session`` returns a ``DeferredOpen`` instance, the client
+    replies to the NSM server immediately and then calls ``load`` in a
+    background thread. Save requests received before loading has finished are
+    held back and carried out afterwards. Requests to open another session
+    are rejected with ``ErrCode.OPERATION_PENDING`` until then.
+
+    """
+
+    def __init__(self, session_path, load):
+        self.session_path = session_path
+        self.load = load
+
+
+# Log messages for error codes received from the NSM server
+_ERROR_MESSAGES = {
+    ErrCode.GENERAL.value: "General error.",
+    ErrCode.INCOMPATIBLE_API.value: "Incompatible API.",
+    ErrCode.BLACKLISTED.value: "Client black listed.",
+}
+
+
+# Messages superseding previous messages of the same group within a batch
+_COALESCE_GROUPS = {
+    MSG_PROGRESS: MSG_PROGRESS,
+    MSG_DIRTY: MSG_DIRTY,
+    MSG_CLEAN: MSG_DIRTY,
+    MSG_LABEL: MSG_LABEL,
+}
+
+
+class _MessageBatch(object):
+    """Queue of outgoing messages used by ``NSMClient.batch``."""
+
+    def __init__(self):
+        self._messages = []
+        self._groups = {}
+
+    def add(self, msg):
+        group = _COALESCE_GROUPS.get(msg[0])
+
+        if group is not None:
+            prev = self._groups.get(group)
+
+            if prev is not None:
+                self._messages[prev] = None
+
+            self._groups[group] = len(self._messages)
+
+        self._messages.append(msg)
+
+    def has_dirty(self):
+        return MSG_DIRTY in self._groups
+
+    def messages(self, dirty=None):
+        """Return queued messages.
+
+        If ``dirty`` is given, a queued dirty/clean message is replaced by one
+        for this state.
+
+        """
+        messages = list(self._messages)
+
+        if dirty is not None and MSG_DIRTY in self._groups:
+            messages[self._groups[MSG_DIRTY]] = (MSG_DIRTY if dirty
+                                                 else MSG_CLEAN,)
+
+        return [msg for msg in messages if msg is not None]
+
+
+class RealtimeSendQueue(object):
+    """Non-blocking queue for dirty and progress updates from real-time threads.
+
+    The ``set_dirty`` and ``update_progress`` methods of the queue only store
+    the value in a pre-allocated slot for the kind of update, replacing a
+    value not sent yet, and never block. They do no logging, capability checks
+    or network I/O. Since only the latest dirty state and progress value
+    matter, no update is lost this way.
+
+    A sender thread checks the slots every ``interval`` seconds and passes the
+    values stored since the previous check on to the client's ``set_dirty``
+    and ``update_progress`` methods, in a single OSC bundle.
+
+    Instances are normally created with ``NSMClient.realtime_queue``.
+
+    """
+
+    OP_DIRTY = 0
+    OP_PROGRESS = 1
+
+    def __init__(self, client, interval=0.01):
+        self.client = client
+        self.interval = interval
+        self._values = array('d', bytes(16))
+        # Number of the last update stored in / sent from each slot
+        self._posted = [0, 0]
+        self._sent = [0, 0]
+        self._counter = count(1)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def set_dirty(self, dirty):
+        """Queue a dirty state update."""
+        self._post(self.OP_DIRTY, 1.0 if dirty else 0.0)
+
+    def update_progress(self, progress):
+        """Queue a progress update."""
+        self._post(self.OP_PROGRESS, progress)
+
+    def _post(self, op, value):
+        # The value is stored before its update number, so the sender never
+        # sees a new number together with an old value. Item assignment and
+        # next() on itertools.count are atomic, so producers need no lock.
+        self._values[op] = value
+        self._posted[op] = next(self._counter)
+
+    def _take(self, op):
+        """Return value stored in slot since it was last sent or ``None``."""
+        posted = self._posted[op]
+
+        if posted == self._sent[op]:
+            return None
+
+        self._sent[op] = posted
+        return self._values[op]
+
+    def start(self):
+        """Start the sender thread."""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True,
+                                            name="RealtimeSendQueue")
+            self._thread.start()
+
+    def stop(self):
+        """Send pending updates and stop the sender thread."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def flush(self):
+        """Pass the latest queued updates on to the client.
+
+        Called regularly by the sender thread. Must not be called from
+        several threads concurrently.
+
+        """
+        dirty = self._take(self.OP_DIRTY)
+        progress = self._take(self.OP_PROGRESS)
+
+        if dirty is None and progress is None:
+            return
+
+        with self.client.batch():
+            if dirty is not None:
+                self.client.set_dirty(dirty != 0.0)
+
+            if progress is not None:
+                self.client.update_progress(progress)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                log.exception("Error sending queued updates.")
+
+        self.flush()
+
+
+def _write_file_atomic(path, content, fsync=True):
+    """Write content to path via a temporary file, which is then renamed.
+
+    ``content`` may be a bytes or str object or a callable, which is passed
+    the binary file object to write to. Missing parent directories are
+    created.
+
+    Module-level function, so it can be run by a process pool executor.
+
+    """
+    directory = dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix='.%s.' % basename(path), suffix='.tmp',
+                               dir=directory)
+
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            if callable(content):
+                content(fp)
+            elif isinstance(content, str):
+                fp.write(content.encode('utf-8'))
+            else:
+                fp.write(content)
+
+            if fsync:
+                fp.flush()
+                os.fsync(fp.fileno())
+
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+        raise
+
+    return path
+
+
+def _write_error_code(exc):
+    """Return the ``ErrCode`` to report for an exception of a write job."""
+    code = getattr(exc, 'code', None)
+
+    if isinstance(code, ErrCode):
+        return code
+    elif isinstance(exc, FileNotFoundError):
+        return ErrCode.NO_SUCH_FILE
+
+    return ErrCode.GENERAL
+
+
+def _path_mtime(path):
+    """Return the latest modification time of a file or directory tree.
+
+    Returns ``None`` if the path does not exist.
+
+    """
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                mtime = max(mtime, os.lstat(join(root, name)).st_mtime_ns)
+            except OSError:
+                pass
+
+    return mtime
+
+
+class SessionCacheEntry(object):
+    """Session state stored in a ``SessionCache``."""
+
+    __slots__ = ('state', 'session_path', 'size', 'mtime')
+
+    def __init__(self, state, session_path, size, mtime):
+        self.state = state
+        self.session_path = session_path
+        self.size = size
+        self.mtime = mtime
+
+
+class SessionCache(object):
+    """LRU cache for the in-memory state of recently opened sessions.
+
+    Entries are keyed by ``(session_prefix, client_id)``. When the cache holds
+    more than ``max_entries`` entries or the total size of the cached states
+    exceeds ``max_bytes`` (if given), the least recently used entries are
+    evicted. An entry is invalidated if a file below its session path has
+    been modified after the entry was stored. The client takes an entry out
+    of the cache when it restores the session from it, since the restored
+    state is modified in place from then on.
+
+    """
+
+    def __init__(self, max_entries=4, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return valid ``SessionCacheEntry`` for key or ``None``."""
+        return self._lookup(key, False)
+
+    def pop(self, key):
+        """Remove and return valid ``SessionCacheEntry`` for key or ``None``.
+        """
+        return self._lookup(key, True)
+
+    def _lookup(self, key, remove):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None:
+                if _path_mtime(entry.session_path) == entry.mtime:
+                    if remove:
+                        self._remove(key)
+                    else:
+                        self._entries.move_to_end(key)
+
+                    self.hits += 1
+                    return entry
+
+                log.debug("Cached session '%s' modified on disk.",
+                          entry.session_path)
+                self._remove(key)
+
+            self.misses += 1
+
+    def put(self, key, state, session_path, size=0):
+        """Store session state and evict least recently used entries."""
+        entry = SessionCacheEntry(state, session_path, size,
+                                  _path_mtime(session_path))
+
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = entry
+            self.size += size
+
+            while self._entries and (
+                    len(self._entries) > self.max_entries or
+                    (self.max_bytes is not None and
+                     self.size > self.max_bytes)):
+                self._remove(next(iter(self._entries)))
+
+    def discard(self, key):
+        """Remove entry for key from the cache, if present."""
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+
+        if entry is not None:
+            self.size -= entry.size
+
+
+class LatencyHistogram(object):
+    """Cumulative histogram of operation latencies in seconds."""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+               30.0, 60.0)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """Add a latency value (in seconds) to the histogram."""
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        """Return dict with count, sum and cumulative bucket counts."""
+        cumulative = []
+        total = 0
+
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            cumulative.append((bound, total))
+
+        return {'count': self.count, 'sum': self.sum, 'buckets': cumulative}
+
+
+class ClientMetrics(object):
+    """Message counters and latency histograms of an ``NSMClient``.
+
+    Counters are plain integers updated without locking, so they may be off
+    by a few counts, when messages are sent from several threads at once.
+
+    """
+
+    def __init__(self):
+        self.sent = {}
+        self.received = {}
+        self.unknown = 0
+        self.unknown_suppressed = 0
+        self.errors_sent = {}
+        self.errors_received = {}
+        self.latency = {
+            'announce': LatencyHistogram(),
+            'open': LatencyHistogram(),
+            'save': LatencyHistogram(),
+        }
+
+    def count(self, counter, key):
+        counter[key] = counter.get(key, 0) + 1
+
+    def snapshot(self):
+        """Return a copy of all metrics as a dictionary."""
+        return {
+            'sent': dict(self.sent),
+            'received': dict(self.received),
+            'unknown': self.unknown,
+            'unknown_suppressed': self.unknown_suppressed,
+            'errors_sent': dict(self.errors_sent),
+            'errors_received': dict(self.errors_received),
+            'latency': {name: hist.snapshot()
+                        for name, hist in self.latency.items()},
+        }
+
+
+class _RateLimiter(object):
+    """Limit the number of events per key within a time window.
+
+    At most ``limit`` events per key are allowed within ``interval`` seconds.
+    At most ``max_keys`` keys are tracked, events for further keys share one
+    window with the key ``None``.
+
+    When a window with suppressed events ends, ``on_suppressed`` is called
+    with the key and the number of suppressed events. This happens in a timer
+    thread, so it does not depend on further events for the same key.
+
+    """
+
+    def __init__(self, limit=5, interval=10.0, max_keys=256,
+                 on_suppressed=None):
+        self.limit = limit
+        self.interval = interval
+        self.max_keys = max_keys
+        self.on_suppressed = on_suppressed
+        # key -> [window start, allowed events, suppressed events]
+        self._windows = {}
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def check(self, key):
+        """Register an event for key and return ``(allowed, key)``.
+
+        The returned key is ``None`` if the event was counted in the shared
+        window.
+
+        """
+        now = time.monotonic()
+        ended = None
+
+        with self._lock:
+            windows = self._windows
+            window = windows.get(key)
+
+            if window is None and len(windows) >= self.max_keys:
+                for expired in [k for k, w in windows.items()
+                                if now - w[0] >= self.interval and not w[2]]:
+                    del windows[expired]
+
+                if len(windows) >= self.max_keys:
+                    key = None
+                    window = windows.get(key)
+
+            if window is None or now - window[0] >= self.interval:
+                # Reported here if the timer hasn't run yet
+                if window is not None and window[2]:
+                    ended = window[2]
+
+                window = windows[key] = [now, 0, 0]
+
+            if window[1] < self.limit:
+                window[1] += 1
+                allowed = True
+            else:
+                window[2] += 1
+                allowed = False
+
+                if self._timer is None:
+                    self._schedule(window[0] + self.interval - now)
+
+        if ended:
+            self._report(key, ended)
+
+        return allowed, key
+
+    def _schedule(self, delay):
+        self._timer = threading.Timer(max(delay, 0.001), self._flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _flush(self):
+        """Report and remove ended windows with suppressed events."""
+        now = time.monotonic()
+
+        with self._lock:
+            self._timer = None
+            windows = self._windows
+            ended = [(k, w[2]) for k, w in windows.items()
+                     if now - w[0] >= self.interval and w[2]]
+
+            for k, _ in ended:
+                del windows[k]
+
+            pending = [w[0] for w in windows.values() if w[2]]
+
+            if pending:
+                self._schedule(min(pending) + self.interval - now)
+
+        for k, count in ended:
+            self._report(k, count)
+
+    def _report(self, key, count):
+        if self.on_suppressed is not None:
+            self.on_suppressed(key, count)
+
+
+def _log_trace(direction, path, args):
+    """Default trace hook, which logs messages with level DEBUG."""
+    log.debug("%s OSC message %s %r",
+              "Received" if direction == TRACE_IN else "Sending", path, args)
+
+
+def _error_name(code):
+    """Return the ``ErrCode`` member name for an error code value."""
+    try:
+        return ErrCode(getattr(code, 'value', code)).name
+    except ValueError:
+        return str(code)
+
+
+class PrometheusExporter(object):
+    """Periodically write client metrics to a file in Prometheus text format.
+
+    The file is replaced atomically, so it can be read at any time, e.g. by
+    the node exporter's textfile collector. Instances are normally created
+    with ``NSMClient.export_metrics``.
+
+    """
+
+    def __init__(self, client, path, interval=10.0):
+        self.client = client
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start the exporter thread."""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True,
+                                            name="PrometheusExporter")
+            self._thread.start()
+
+    def stop(self):
+        """Stop the exporter thread after writing the metrics once more."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def write(self):
+        """Write the current metrics to the output file."""
+        tmp = self.path + ".tmp"
+
+        with open(tmp, 'w') as fp:
+            fp.write(self.format())
+
+        os.replace(tmp, self.path)
+
+    def format(self):
+        """Return the current metrics in Prometheus text format."""
+        client = self.client
+        state = getattr(client, 'state', None)
+        labels = 'client="%s",client_id="%s"' % (
+            _prom_escape(client.app_name),
+            _prom_escape(getattr(state, 'client_id', None) or ""))
+        metrics = client.metrics()
+        lines = []
+
+        def counter(name, help, values, label):
+            lines.append("# HELP nsmclient_%s %s" % (name, help))
+            lines.append("# TYPE nsmclient_%s counter" % name)
+
+            for key, value in sorted(values.items()):
+                lines.append('nsmclient_%s{%s,%s="%s"} %i' % (
+                    name, labels, label, _prom_escape(key), value))
+
+        counter("messages_sent_total", "OSC messages sent by path.",
+                metrics['sent'], "path")
+        counter("messages_received_total", "OSC messages received by path.",
+                metrics['received'], "path")
+        counter("unknown_messages_total", "Unknown OSC messages received.",
+                {"*": metrics['unknown']}, "path")
+        counter("unknown_messages_suppressed_total",
+                "Unknown OSC messages not logged due to rate limiting.",
+                {"*": metrics['unknown_suppressed']}, "path")
+        counter("errors_sent_total", "Errors sent to the server by code.",
+                metrics['errors_sent'], "code")
+        counter("errors_received_total",
+                "Errors received from the server by code.",
+                metrics['errors_received'], "code")
+        counter("saves_total", "Save requests by outcome.",
+                metrics['saves'], "outcome")
+
+        lines.append("# HELP nsmclient_latency_seconds Operation latency.")
+        lines.append("# TYPE nsmclient_latency_seconds histogram")
+
+        for op, hist in sorted(metrics['latency'].items()):
+            oplabels = '%s,operation="%s"' % (labels, op)
+
+            for bound, count in hist['buckets']:
+                le = "+Inf" if bound == float('inf') else repr(bound)
+                lines.append('nsmclient_latency_seconds_bucket{%s,le="%s"} %i'
+                             % (oplabels, le, count))
+
+            lines.append('nsmclient_latency_seconds_sum{%s} %r' %
+                         (oplabels, hist['sum']))
+            lines.append('nsmclient_latency_seconds_count{%s} %i' %
+                         (oplabels, hist['count']))
+
+        return "\n".join(lines) + "\n"
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except Exception:
+                log.exception("Error writing metrics to '%s'.", self.path)
+
+        self.write()
+
+
+def _prom_escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+# Trace file header: magic, format version
+_TRACE_MAGIC = b'NSMTRACE'
+_TRACE_VERSION = 1
+_TRACE_HEADER = struct.Struct('<8sI')
+# Record: direction, time since start of recording, handler duration,
+# length of the following OSC message
+_TRACE_RECORD = struct.Struct('<BdfI')
+# Handler duration field and its offset within a record
+_TRACE_DURATION = struct.Struct('<f')
+_TRACE_DURATION_OFFSET = struct.calcsize('<Bd')
+
+TraceRecord = namedtuple('TraceRecord',
+                         'direction time duration path args types')
+ReplayTiming = namedtuple('ReplayTiming', 'time path recorded replayed')
+
+
+class TraceRecorder(object):
+    """Write OSC messages sent and received by a client to a trace file.
+
+    Each record consists of the direction (``TRACE_IN`` or ``TRACE_OUT``),
+    the time in seconds since the start of the recording (from the monotonic
+    clock), the time spent in the message handler (for incoming messages) and
+    the message encoded as an OSC packet. Records of incoming messages are
+    written before the handler is called and its duration is filled in when
+    it returns, so the records are in time order.
+
+    Instances are normally created with ``NSMClient.start_recording``.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fp = open(path, 'wb')
+        self._fp.write(_TRACE_HEADER.pack(_TRACE_MAGIC, _TRACE_VERSION))
+        self._lock = threading.Lock()
+        self.start = time.monotonic()
+
+    def write(self, direction, timestamp, duration, path, args, types=None):
+        """Append a message record to the trace file.
+
+        ``types`` is the type tag string of a received message. If given, the
+        arguments are recorded with these types instead of the ones guessed
+        from their Python values, so e.g. doubles and 64-bit integers are
+        replayed as such.
+
+        Returns the position of the record, which can be passed to
+        ``set_duration``, or ``None`` if the message was not recorded.
+
+        """
+        if types and len(types) == len(args):
+            args = tuple(zip(types, args))
+
+        try:
+            data = encode_osc_message(path, *args,
+                                      cache=direction == TRACE_OUT)
+        except Exception as exc:
+            log.debug("Cannot record message %s %r: %s", path, args, exc)
+            return
+
+        with self._lock:
+            if self._fp is not None:
+                pos = self._fp.tell()
+                self._fp.write(_TRACE_RECORD.pack(
+                    direction, timestamp - self.start, duration, len(data)))
+                self._fp.write(data)
+                return pos
+
+    def set_duration(self, pos, duration):
+        """Set the handler duration of the record at the given position."""
+        with self._lock:
+            if self._fp is not None:
+                end = self._fp.tell()
+                self._fp.seek(pos + _TRACE_DURATION_OFFSET)
+                self._fp.write(_TRACE_DURATION.pack(duration))
+                self._fp.seek(end)
+
+    def close(self):
+        """Close the trace file."""
+        with self._lock:
+            if self._fp is not None:
+                self._fp.close()
+                self._fp = None
+
+
+def read_trace(path):
+    """Iterate over the records of a trace file as ``TraceRecord`` tuples."""
+    with open(path, 'rb') as fp:
+        magic, version = _TRACE_HEADER.unpack(
+            fp.read(_TRACE_HEADER.size) or bytes(_TRACE_HEADER.size))
+
+        if magic != _TRACE_MAGIC or version != _TRACE_VERSION:
+            raise ValueError("'%s' is not an nsmclient trace file." % path)
+
+        while True:
+            header = fp.read(_TRACE_RECORD.size)
+
+            if len(header) < _TRACE_RECORD.size:
+                # End of file or truncated record of an aborted recording
+                break
+
+            direction, timestamp, duration, size = _TRACE_RECORD.unpack(
+                header)
+            data = fp.read(size)
+
+            if len(data) < size:
+                break
+
+            path, args, types = decode_osc_message(data)
+            yield TraceRecord(direction, timestamp, duration, path, args,
+                              types)
+
+
+class TraceReplayer(object):
+    """Feed the incoming messages of a trace file into a client.
+
+    ``run`` calls the handlers of the client for all incoming messages in the
+    trace, either at the original pace or as fast as possible, and returns
+    the time spent in each handler together with the time recorded in the
+    trace. Messages sent by the client go to the NSM server the client is
+    connected to. If the client has not been initialized (i.e. it was created
+    with ``init=False``), its OSC server is started and the messages are sent
+    to a local UDP port, where they are discarded.
+
+    Note that in executor mode and for ``AsyncNSMClient`` the handler time of
+    open and save requests only includes scheduling the operation.
+
+    """
+
+    # Destination of messages sent by uninitialized clients (discard port)
+    discard_url = "osc.udp://127.0.0.1:9/"
+
+    def __init__(self, path):
+        self.path = path
+        self.records = list(read_trace(path))
+
+    def run(self, client, realtime=True):
+        """Replay the trace and return a list of ``ReplayTiming`` tuples."""
+        if getattr(client, 'state', None) is None:
+            client.state = ClientState(self.discard_url)
+            client._joined = threading.Event()
+            client._start_transport()
+
+        incoming = [rec for rec in self.records if rec.direction == TRACE_IN]
+        timings = []
+        start = time.monotonic()
+        offset = incoming[0].time if incoming else 0.0
+
+        for rec in incoming:
+            if realtime:
+                delay = start + rec.time - offset - time.monotonic()
+
+                if delay > 0:
+                    time.sleep(delay)
+
+            handler_start = time.monotonic()
+            client._dispatch(rec.path, list(rec.args), rec.types, None)
+            timings.append(ReplayTiming(rec.time, rec.path, rec.duration,
+                                        time.monotonic() - handler_start))
+
+        return timings
+
+    @staticmethod
+    def summary(timings):
+        """Return total recorded and replayed handler time by message path.
+
+        Returns a dict mapping each path to a dict with the keys ``count``,
+        ``recorded``, ``replayed`` and ``difference`` (replayed minus
+        recorded time in seconds).
+
+        """
+        result = {}
+
+        for timing in timings:
+            entry = result.setdefault(timing.path, {
+                'count': 0, 'recorded': 0.0, 'replayed': 0.0})
+            entry['count'] += 1
+            entry['recorded'] += timing.recorded
+            entry['replayed'] += timing.replayed
+
+        for entry in result.values():
+            entry['difference'] = entry['replayed'] - entry['recorded']
+
+        return result
+
+
+# Only one operation can be profiled at a time per process
+_profile_lock = threading.Lock()
+
+
+class OperationProfiler(object):
+    """Profile client operations with cProfile and tracemalloc.
+
+    For each profiled operation, the cProfile statistics are written to a
+    ``.pstats`` file, which can be loaded with the ``pstats`` module, and the
+    ``top`` source lines allocating the most memory during the operation to a
+    ``.alloc.txt`` file. The files are written to ``directory`` or, if it is
+    ``None``, to the directory containing the session path (or, before a
+    session was opened, the system's temporary directory). File names contain
+    the client ID, the operation name and a timestamp.
+
+    Only one operation is profiled at a time, operations started while
+    another one is being profiled, e.g. in other threads, are run normally.
+    The allocation report includes memory allocated by other threads during
+    the operation.
+
+    Instances are normally created with ``NSMClient.enable_profiling``.
+
+    """
+
+    def __init__(self, directory=None, top=25):
+        self.directory = directory
+        self.top = top
+        self.runs = 0
+
+    def run(self, op, path, client_id, func, *args, **kwargs):
+        """Call func with the given arguments and profile the call.
+
+        ``op`` is the name of the operation, ``path`` the session path the
+        output directory is derived from, if no directory is set.
+
+        """
+        if not _profile_lock.acquire(False):
+            return func(*args, **kwargs)
+
+        try:
+            started = not tracemalloc.is_tracing()
+
+            if started:
+                tracemalloc.start()
+
+            profile = cProfile.Profile()
+
+            try:
+                return profile.runcall(func, *args, **kwargs)
+            finally:
+                snapshot = tracemalloc.take_snapshot()
+                peak = tracemalloc.get_traced_memory()[1]
+
+                if started:
+                    tracemalloc.stop()
+
+                try:
+                    self._write(op, path, client_id, profile, snapshot, peak)
+                except Exception:
+                    log.exception("Could not write profile of '%s'.", op)
+        finally:
+            _profile_lock.release()
+
+    def _write(self, op, path, client_id, profile, snapshot, peak):
+        directory = self.directory
+
+        if directory is None:
+            directory = (dirname(path.rstrip(os.sep)) if path
+                         else tempfile.gettempdir())
+
+        os.makedirs(directory, exist_ok=True)
+        self.runs += 1
+        basepath = join(directory, "%s-%s-%s-%i-%i" % (
+            client_id or "nsmclient", re.sub(r'[^\w.-]+', '_', op).strip('_'),
+            time.strftime('%Y%m%d-%H%M%S'), os.getpid(), self.runs))
+        profile.dump_stats(basepath + ".pstats")
+        snapshot = snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),))
+
+        with open(basepath + ".alloc.txt", 'w') as fp:
+            fp.write("Operation: %s\nClient ID: %s\n" % (op, client_id))
+            fp.write("Peak traced memory: %.1f KiB\n\n" % (peak / 1024))
+            fp.write("Top %i allocations by source line:\n" % self.top)
+
+            for stat in snapshot.statistics('lineno')[:self.top]:
+                fp.write("%s\n" % stat)
+
+        log.info("Profile of '%s' written to '%s.pstats'.", op, basepath)
+
+
+class GUIDispatcher(object):
+    """Run the GUI callbacks of a client in the thread of a GUI toolkit.
+
+    The ``show_gui`` and ``hide_gui`` methods of a client are called via
+    ``call_soon``, which must not block. When they have returned, the client
+    reports the new GUI state to the server from a function passed to
+    ``call_when_idle``, so that the report is sent after the toolkit has
+    processed the events caused by showing or hiding the GUI.
+
+    This base class calls both functions immediately in the calling thread.
+    Sub-classes for Qt, GLib / GTK and tkinter post them to the toolkit's main
+    loop.
+
+    """
+
+    def call_soon(self, func):
+        """Arrange for func to be called in the GUI thread.
+
+        May be called from any thread.
+
+        """
+        func()
+
+    def call_when_idle(self, func):
+        """Call func once all pending GUI events have been processed.
+
+        Is called from the GUI thread.
+
+        """
+        func()
+
+
+def _import_qt_core():
+    """Return the QtCore module of the Qt binding used by the application."""
+    bindings = ('PySide6', 'PyQt6', 'PyQt5', 'PySide2')
+
+    for binding in bindings:
+        if binding in sys.modules:
+            return __import__(binding + '.QtCore', fromlist=['QtCore'])
+
+    for binding in bindings:
+        try:
+            return __import__(binding + '.QtCore', fromlist=['QtCore'])
+        except ImportError:
+            pass
+
+    raise ImportError("No Qt binding (PySide6, PyQt6, PyQt5, PySide2) found.")
+
+
+class QtDispatcher(GUIDispatcher):
+    """Run GUI callbacks in the Qt main thread.
+
+    Uses the Qt binding already imported by the application, if any, or the
+    first one found of PySide6, PyQt6, PyQt5 and PySide2. Must be created in
+    the Qt main thread.
+
+    """
+
+    def __init__(self):
+        QtCore = _import_qt_core()
+        signal = getattr(QtCore, 'pyqtSignal', None) or QtCore.Signal
+        slot = getattr(QtCore, 'pyqtSlot', None) or QtCore.Slot
+        queued = getattr(QtCore.Qt, 'ConnectionType',
+                         QtCore.Qt).QueuedConnection
+
+        class Invoker(QtCore.QObject):
+            posted = signal(object)
+
+            @slot(object)
+            def invoke(self, func):
+                func()
+
+        self._invoker = Invoker()
+        self._invoker.posted.connect(self._invoker.invoke, queued)
+        self._timer = QtCore.QTimer
+
+    def call_soon(self, func):
+        # Signals emitted from other threads are queued to the receiver's
+        # thread by Qt.
+        self._invoker.posted.emit(func)
+
+    def call_when_idle(self, func):
+        self._timer.singleShot(0, func)
+
+
+class GLibDispatcher(GUIDispatcher):
+    """Run GUI callbacks in the GLib main loop (e.g. for GTK applications).
+
+    Requires PyGObject.
+
+    """
+
+    def __init__(self):
+        from gi.repository import GLib
+        self._glib = GLib
+
+    def call_soon(self, func):
+        self._glib.idle_add(self._call_once, func,
+                            priority=self._glib.PRIORITY_DEFAULT)
+
+    def call_when_idle(self, func):
+        # Lower than the priority of GTK's resize and redraw sources
+        self._glib.idle_add(self._call_once, func,
+                            priority=self._glib.PRIORITY_DEFAULT_IDLE)
+
+    @staticmethod
+    def _call_once(func):
+        func()
+        return False
+
+
+class TkDispatcher(GUIDispatcher):
+    """Run GUI callbacks in the tkinter main loop.
+
+    tkinter widgets must not be used from other threads, and calls from other
+    threads into Tcl may block until the main loop handles them, so posted
+    functions are put into a queue, which is checked every ``interval``
+    milliseconds by a timer in the main loop. Must be created in the tkinter
+    main thread.
+
+    """
+
+    def __init__(self, root, interval=50):
+        self.root = root
+        self.interval = interval
+        self._queue = deque()
+        root.after(interval, self._poll)
+
+    def call_soon(self, func):
+        self._queue.append(func)
+
+    def call_when_idle(self, func):
+        self.root.after_idle(func)
+
+    def _poll(self):
+        queue = self._queue
+
+        while queue:
+            func = queue.popleft()
+
+            try:
+                func()
+            except Exception:
+                log.exception("Error in GUI callback.")
+
+        self.root.after(self.interval, self._poll)
+
+
+class ClientState(object):
+    """Simple data class to store NSM client state."""
+
+    def __init__(self, url):
+        # NSM reported the session is loaded
+        # set by NSMClient.session_loaded()
+        self.session_loaded = False
+        # NSM_URL environment variable
+        # set by NSMClient.init()
+        self.nsm_url = url
+        # set by NSMClient.handle_welcome()
+        self.session_joined = False
+        self.welcome_msg = None
+        self.nsm_name = None
+        # Test for a server capability with:
+        # capability in self.server_capabilities
+        self.server_capabilities = set()
+        # set by NSMClient.handle_open()
+        self.session_prefix = None
+        self.session_path = None
+        self.session_name = None
+        self.client_id = None
+        # Everything is clean and shiny in the beginning.
+        self.dirty = False
+
+
+class NSMClient(abc.ABC):
+    """Abstract base class for NSM client implementations."""
+
+    def __init__(self, name=None, init=True, quit_on_error=True, show_gui=True,
+                 executable=None, timeout=5, retries=0, backend=None,
+                 executor=None, skip_unchanged_saves=False, host=None,
+                 threaded=True, session_cache=None, gui_dispatcher=None):
+        """Create an NSMClient instance.
+
+        It ``init`` is ``True`` (the default), announce the client to the NSM
+        server immediately and thereby join the NSM session.
+
+        If joining a session fails or the ``open_session`` or ``save_session``
+        methods raise an exception, the client program is shut down by calling
+        the ``close`` instance method when ``quit_on_error`` is ``True`` (the
+        default).
+
+        The remaining keyword arguments are passed to the ``init`` method.
+
+        If the client *and* the server have the CAP_OPTIONAL_GUI capability and
+        if the ``show_gui`` argument is ``True`` (the default), the client's
+        ``show_gui`` method is called after the NSM session has been joined, or
+        the ``hide_gui`` method if it is ``False``.
+
+        If the server does not have the CAP_OPTIONAL_GUI capability, but the
+        client does, the ``show_gui`` method is called unconditionally.
+
+        ``backend`` selects the OSC transport implementation: ``BACKEND_LIBLO``
+        uses pyliblo, ``BACKEND_UDP`` uses the built-in pure-Python UDP
+        implementation. By default, pyliblo is used if it is installed.
+
+        The OSC server is only created, the ``SIGTERM`` handler installed and
+        pyliblo imported, when ``init`` is called and the ``NSM_URL``
+        environment variable is set.
+
+        If ``executor`` is given, it must be a ``concurrent.futures.Executor``
+        instance, e.g. a ``ThreadPoolExecutor``. The ``open_session`` and
+        ``save_session`` methods are then run by the executor instead of the
+        OSC server thread, so other messages from the server are still
+        handled while they are running. The reply is sent to the server when
+        the operation has completed. Operations are run one at a time:
+
+        * An open request received while another operation is running is
+          carried out after it. If the running operation is an open, it is
+          cancelled via the ``CancellationToken`` passed to ``open_session``.
+          An open request still waiting to be run is answered with an
+          ``ErrCode.OPERATION_PENDING`` error, when it is superseded by a
+          newer one.
+        * A save request received while a save is running is carried out
+          after it. Further save requests received in the meantime are
+          coalesced with the waiting one and all are answered when it has
+          completed.
+        * A save request received while an open is running or waiting is
+          answered with an ``ErrCode.OPERATION_PENDING`` error.
+
+        With a ``ProcessPoolExecutor``, the client instance is pickled and the
+        methods run in a child process, so any changes they make to the
+        client's attributes are not visible in the main process. Messages
+        sent from the child process, e.g. with ``set_dirty``,
+        ``update_progress`` or ``progress``, are not sent to the NSM server.
+
+        If ``skip_unchanged_saves`` is ``True``, save requests are answered
+        immediately without calling ``save_session``, if the session has
+        already been saved successfully since it was opened and it has not
+        changed since then. The session is considered unchanged, if the client
+        has the CAP_DIRTY capability and is not dirty, or if the
+        ``session_fingerprint`` method returns the same value as for the last
+        successful save. The number of performed and skipped saves is
+        available in the ``save_stats`` dictionary.
+
+        If ``host`` is given, it must be a ``NSMClientHost`` instance. The
+        client then does not start its own OSC server thread, but its messages
+        are received by the host's receive thread, which is shared by all
+        clients of the host. The client also does not install a ``SIGTERM``
+        handler and ``close`` does not exit the program.
+
+        If ``threaded`` is ``False``, the client does not start an OSC server
+        thread. Instead, the program must call the ``process_pending`` method
+        regularly or whenever the file descriptor returned by ``fileno``
+        becomes readable, e.g. from its own ``select``/``poll`` loop or via a
+        Qt socket notifier or GLib IO watch. All message handlers are then run
+        in the thread calling ``process_pending``.
+
+        ``session_cache`` may be a ``SessionCache`` instance. Clients with the
+        CAP_SWITCH capability then keep the state of recently opened sessions
+        in memory and restore it, instead of calling ``open_session``, when
+        switching back to a session, whose files have not been modified since.
+        This requires implementing the ``get_session_state`` and
+        ``restore_session_state`` methods and, if the cache has a
+        ``max_bytes`` limit, ``session_state_size``.
+
+        ``gui_dispatcher`` may be a ``GUIDispatcher`` instance, e.g. a
+        ``QtDispatcher``, ``GLibDispatcher`` or ``TkDispatcher``, which is
+        used to call the ``show_gui`` and ``hide_gui`` methods in the thread
+        of the GUI toolkit, instead of the thread receiving NSM messages.
+
+        """
+        self.name = name
+        self.gui_dispatcher = gui_dispatcher
+        self.quit_on_error = quit_on_error
+        self._show_gui = show_gui
+        self.backend = backend
+        self._init_dispatch()
+        self.executor = executor
+        self._pending_op = None
+        self.skip_unchanged_saves = skip_unchanged_saves
+        self.save_stats = dict.fromkeys(SAVE_STATS_KEYS, 0)
+        self._saved_path = None
+        self._saved_fingerprint = None
+        self._next_fingerprint = None
+        self._local = threading.local()
+        self._dirty_lock = threading.Lock()
+        self.session_cache = session_cache
+
+        if (session_cache is not None and session_cache.max_bytes is not None
+                and type(self).session_state_size is
+                NSMClient.session_state_size):
+            raise TypeError("Clients using a session cache with a max_bytes "
+                            "limit must implement session_state_size().")
+        self.host = host
+        self.threaded = threaded and host is None
+        # The OSC server is created by init()
+        self.osc_server = None
+        self.startup_timings = {}
+        # Operation scheduling in executor mode
+        self._sched_lock = threading.Lock()
+        self._open_token = None
+        self._queued_open = None
+        self._queued_saves = 0
+        self._metrics = ClientMetrics()
+        self._init_unknown_limiter()
+        self._op_start = None
+
+        if log.isEnabledFor(logging.DEBUG):
+            self.set_tracing(True)
+
+        profile_dir = os.environ.get('NSMCLIENT_PROFILE')
+
+        if profile_dir:
+            self.enable_profiling(None if profile_dir == '1' else profile_dir)
+        # Set while a DeferredOpen is loading in the background
+        self._loading = None
+        self._load_lock = threading.Lock()
+        self._load_failed = False
+        self._held_saves = 0
+
+        if init:
+            self.init(executable=executable, timeout=timeout, retries=retries)
+
+    # Attributes, which are not copied when the client instance is pickled,
+    # e.g. to run open_session / save_session in a process pool.
+    _transient_attrs = ('osc_server', 'executor', 'host', '_joined',
+                        '_local', '_dirty_lock', '_handlers',
+                        '_reply_handlers', '_loading', '_load_lock',
+                        '_recorder', '_tracer', 'gui_dispatcher',
+                        '_sched_lock', '_open_token', 'session_cache',
+                        '_unknown_limiter')
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+
+        for attr in self._transient_attrs:
+            state.pop(attr, None)
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # The copy has no OSC server, so messages sent from it, e.g. progress
+        # updates sent by open_session in a child process, are dropped.
+        self.osc_server = self.executor = self.host = None
+        self.session_cache = None
+        self._loading = self._open_token = None
+        self._local = threading.local()
+        self._dirty_lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._sched_lock = threading.Lock()
+        self._joined = threading.Event()
+        self._init_dispatch()
+        self._init_unknown_limiter()
+
+    # Set by _freeze_capabilities() when the client is announced
+    _caps = None
+    _announce_caps = None
+    # Set by start_recording()
+    _recorder = None
+    # Set by set_tracing()
+    _tracer = None
+    # Set by enable_profiling()
+    _profiler = None
+    gui_dispatcher = None
+
+    # At most this many warnings per path are logged for unknown messages
+    # within unknown_log_interval seconds.
+    unknown_log_limit = 5
+    unknown_log_interval = 10.0
+
+    # public API functions
+
+    def init(self, executable=None, timeout=5, retries=0, retry_interval=0.5,
+             backoff=2.0):
+        """Announce the NSM client to the NSM server.
+
+        The client tries to get the OSC URL of the server from the ``NSM_URL``
+        environment variable. If it is not set or empty, a ``RuntimeError``
+        exception will be raised.
+
+        The ``excutable`` argument sets the name of the executable file of the
+        NSM client reported to the NSM server. If it is not passed or false, it
+        will be determined automatically. In certain situations, e.g. when
+        running the Python client from a shell script via ``exec``, this may
+        not result in the correct or desired value being used, so this
+        parameter allows to override it.
+
+        ``timeout`` sets the maxiumum time period in seconds, for which the
+        client blocks and waits for the server's reply to its announce message.
+        If the server does not reply within the timeout, a ``RuntimeError``
+        exception is raised. The wait ends as soon as the reply is received.
+
+        If ``retries`` is greater than zero, the announce message is sent again
+        up to this many times within the timeout period, if no reply has been
+        received yet. The first resend happens after ``retry_interval``
+        seconds, and the interval is multiplied by ``backoff`` after each
+        resend. Resends are disabled by default, because some servers may
+        handle repeated announce messages as separate client registrations.
+
+        Returns the time in seconds between sending the (first) announce
+        message and receiving the server's reply, or ``None`` if ``timeout`` is
+        zero or ``None``.
+
+        The time spent in the individual steps of joining the session is
+        stored in the ``startup_timings`` dictionary (in seconds): importing
+        the OSC backend (``backend``), creating and starting the OSC server
+        (``server``), sending the announce message (``announce``) and waiting
+        for the reply (``handshake``).
+
+        """
+        executable = self._prepare_announce(executable)
+        self._start_transport()
+
+        # Finally tell NSM we are ready and start the main loop
+        start = time.perf_counter()
+        sent = time.monotonic()
+        self.announce(executable, os.getpid())
+        start = self._record_timing('announce', start)
+
+        # Wait for the welcome message.
+        if not timeout:
+            return None
+
+        for wait in self._announce_waits(sent, timeout, retries,
+                                         retry_interval, backoff):
+            if self._wait_joined(wait):
+                break
+
+            if time.monotonic() - sent < timeout:
+                log.debug("No reply to announce yet, resending.")
+                self.announce(executable, os.getpid())
+
+        if self._joined.is_set():
+            self._record_timing('handshake', start)
+            latency = time.monotonic() - sent
+            self._metrics.latency['announce'].observe(latency)
+            return latency
+
+        raise RuntimeError("No response from NSM server within "
+                           "timeout (%s sec.)." % timeout)
+
+    def send_message(self, message, priority=0):
+        """Send a status message to the NSM server.
+
+        /nsm/client/message i:priority s:message
+
+        Clients may send miscellaneous status updates to the server for
+        possible display to the user. This may simply be chatter that is
+        normally written to the console. priority should be a number from 0 to
+        3, 3 being the most important. Clients which have this capability
+        should include :message: in their announce capability string.
+
+        """
+        if self._has_capability(CAP_MESSAGE):
+            self.send(MSG_MESSAGE, int(priority), str(message))
+        else:
+            log.warning("The client tried to send a status message but was "
+                        "not initialized with the 'message' capability. "
+                        "The message was not sent. Get rid of this warning by "
+                        "setting the 'message' capability flag to True or "
+                        "remove the message update from the code")
+
+    def set_dirty(self, dirty, internal=False):
+        """Report state change to NSM server.
+
+        /nsm/client/is_dirty
+        /nsm/client/is_clean
+
+        Some clients may be able to inform the server when they have unsaved
+        changes pending. Such clients may optionally send is_dirty and is_clean
+        messages. Clients which have this capability should include :dirty: in
+        their announce capability string.
+
+        This method may be called from any thread.
+
+        """
+        if self._has_capability(CAP_DIRTY):
+            with self._dirty_lock:
+                if dirty and not self.state.dirty:
+                    self.state.dirty = True
+                    self.send(MSG_DIRTY)
+                elif not dirty and self.state.dirty:
+                    self.state.dirty = False
+                    self.send(MSG_CLEAN)
+        elif not internal:
+            log.warning("The client tried to send a dirty/clean update, "
+                        "but was not initialized with the 'dirty' capability. "
+                        "The message was not sent. "
+                        "Get rid of this warning by setting the 'dirty' "
+                        "capability flag to True or remove the dirty update "
+                        "from the code.")
+
+    def set_label(self, label):
+        """Set the client label in the NSM GUI."""
+        self.send(MSG_LABEL, str(label))
+
+    def update_progress(self, progress):
+        """Report progress update to NSM server.
+
+        /nsm/client/progress f:progress
+
+        progress must be a float between 0 and 1.0.
+
+        For potentially time-consuming operations, such as save and open,
+        progress updates may be reported to the NSM server throughout the
+        duration of the operation, by sending a floating point value between
+        0.0 and 1.0. The value 1.0 indicates completion. The server will not
+        send a response to these messages, but will relay the information to
+        the user.
+
+        """
+        if self._has_capability(CAP_PROGRESS):
+            self.send(MSG_PROGRESS, float(progress))
+        else:
+            log.warning("The client tried to send a progress update but was "
+                        "not initialized with the 'progress' capability. "
+                        "The message was not sent. Get rid of this warning by "
+                        "setting the 'progress' capability flag or remove the "
+                        "progress update from the code.")
+
+    def progress(self, total=None, iterable=None, interval=0.1,
+                 min_delta=0.01):
+        """Return a ``ProgressReporter`` for a time-consuming operation.
+
+        Unlike ``update_progress``, the returned reporter limits the rate of
+        progress messages sent to the server: a message is only sent if at
+        least ``interval`` seconds have passed since the last one and the
+        progress has increased by at least ``min_delta``.
+
+        ``total`` is the number of work units of the operation. If
+        ``iterable`` is given, the reporter can be iterated over and advances
+        by one unit per item. ``total`` defaults to ``len(iterable)``.
+
+        """
+        return ProgressReporter(self, total, iterable, interval, min_delta)
+
+    def save_files(self, jobs, max_workers=None, executor=None, fsync=True,
+                   progress=True):
+        """Write many independent session files concurrently.
+
+        Intended to be called from ``save_session`` for sessions stored as a
+        directory of files. ``jobs`` is a mapping or an iterable of
+        ``(path, content)`` pairs. Relative paths are relative to the session
+        path. ``content`` may be a bytes or str object or a callable, which
+        is passed a binary file object to write to.
+
+        Each file is written to a temporary file first, which is then renamed
+        to the target path, so a file is either completely written or left
+        unchanged. The jobs are run with ``executor`` or, if it is ``None``, a
+        thread pool with ``max_workers`` threads. When using a process pool,
+        callables passed as content must be picklable.
+
+        If ``progress`` is true and the client has the ``progress``
+        capability, the completion of the jobs is reported to the server as a
+        single throttled progress stream.
+
+        If any job fails, the remaining jobs not yet started are cancelled
+        and an ``NSMError`` with the error code matching the first failure
+        is raised, which ``handle_save`` reports to the server. Returns the
+        list of written paths.
+
+        """
+        if hasattr(jobs, 'items'):
+            jobs = jobs.items()
+
+        session_path = self.state.session_path
+        jobs = [(join(session_path, path), content) for path, content in jobs]
+        reporter = None
+
+        if progress and self._has_capability(CAP_PROGRESS):
+            reporter = self.progress(total=len(jobs))
+
+        own_executor = executor is None
+
+        if own_executor:
+            executor = ThreadPoolExecutor(max_workers)
+
+        futures = {}
+        failures = []
+
+        try:
+            for path, content in jobs:
+                future = executor.submit(_write_file_atomic, path, content,
+                                         fsync)
+                futures[future] = path
+
+            for future in as_completed(futures):
+                if future.cancelled():
+                    continue
+
+                try:
+                    future.result()
+                except Exception as exc:
+                    log.error("Could not write '%s': %s", futures[future],
+                              exc)
+
+                    if not failures:
+                        for pending in futures:
+                            pending.cancel()
+
+                    failures.append((futures[future], exc))
+                else:
+                    if reporter is not None:
+                        reporter.advance()
+        finally:
+            if own_executor:
+                executor.shutdown(wait=True)
+
+        if failures:
+            path, exc = failures[0]
+            raise NSMError("{} of {} files could not be written, first error "
+                           "'{}': {}".format(len(failures), len(jobs), path,
+                                             exc),
+                           _write_error_code(exc))
+
+        if reporter is not None:
+            reporter.finish()
+
+        return [path for path, content in jobs]
+
+    @contextmanager
+    def batch(self):
+        """Context manager to send messages to the server in one OSC bundle.
+
+        Messages sent by the current thread within the ``with`` block are
+        queued and sent together as a single OSC bundle when the block is
+        left. Progress, dirty/clean and label messages superseded by a later
+        message of the same kind within the block are dropped::
+
+            with client.batch():
+                client.send_message("Finished loading.")
+                client.update_progress(1.0)
+                client.set_dirty(False)
+
+        Nested ``with`` blocks are merged into the outermost one. A queued
+        dirty/clean message is sent for the dirty state at the time the block
+        is left, since another thread may have changed it in the meantime.
+
+        """
+        if getattr(self._local, 'batch', None) is not None:
+            yield
+            return
+
+        batch = self._local.batch = _MessageBatch()
+
+        try:
+            yield
+        finally:
+            self._local.batch = None
+
+            if batch.has_dirty():
+                # Another thread may have changed the dirty state since the
+                # message was queued, so send the current state and keep it
+                # from changing until it has been sent.
+                with self._dirty_lock:
+                    self._send_batch(batch.messages(self.state.dirty))
+            else:
+                self._send_batch(batch.messages())
+
+    def _send_batch(self, messages):
+        if len(messages) == 1:
+            self.send(*messages[0])
+        elif messages:
+            self._send_bundle(messages)
+
+    def realtime_queue(self, interval=0.01):
+        """Create, start and return a ``RealtimeSendQueue`` for this client.
+
+        See the ``RealtimeSendQueue`` docstring for the meaning of the
+        arguments.
+
+        """
+        queue = RealtimeSendQueue(self, interval)
+        queue.start()
+        return queue
+
+    def metrics(self):
+        """Return a snapshot of the client's message and latency metrics.
+
+        The returned dictionary has these keys:
+
+        ``sent``, ``received``
+            Number of OSC messages sent / received by OSC path.
+            Messages without a handler are counted under the path ``'*'``
+            in ``received``.
+        ``unknown``
+            Number of received messages without a handler.
+        ``unknown_suppressed``
+            Number of those, for which no warning was logged due to rate
+            limiting.
+        ``errors_sent``, ``errors_received``
+            Number of error replies sent / received by ``ErrCode`` name.
+        ``saves``
+            A copy of ``save_stats``.
+        ``latency``
+            Histograms for the ``announce``, ``open`` and ``save``
+            operations, each a dict with ``count``, ``sum`` (in seconds) and
+            ``buckets``, a list of ``(upper_bound, cumulative_count)`` tuples.
+
+        """
+        metrics = self._metrics.snapshot()
+        metrics['saves'] = dict(self.save_stats)
+        return metrics
+
+    def export_metrics(self, path, interval=10.0):
+        """Start writing metrics periodically to a file.
+
+        The file is written in the Prometheus text exposition format every
+        ``interval`` seconds. Returns the ``PrometheusExporter`` instance,
+        call its ``stop`` method to stop exporting.
+
+        """
+        exporter = PrometheusExporter(self, path, interval)
+        exporter.start()
+        return exporter
+
+    def set_tracing(self, enabled=True, hook=None):
+        """Enable or disable tracing of sent and received OSC messages.
+
+        When enabled, ``hook`` is called with the direction (``TRACE_IN`` or
+        ``TRACE_OUT``), the OSC path and the arguments of every message. The
+        default hook logs the message with level DEBUG. When disabled, the
+        cost of tracing is one attribute lookup per message.
+
+        Tracing is enabled on instantiation, if the ``nsmclient`` logger has
+        level DEBUG at that time.
+
+        """
+        self._tracer = (hook or _log_trace) if enabled else None
+
+    def enable_profiling(self, directory=None, top=25):
+        """Profile open and save operations and message handlers.
+
+        Each call of ``open_session``, ``save_session`` and of the handlers
+        for other incoming messages is profiled with cProfile and tracemalloc
+        and the results are written to files in ``directory``. See
+        ``OperationProfiler`` for details. Returns the ``OperationProfiler``
+        instance.
+
+        Profiling is also enabled on instantiation, if the environment
+        variable ``NSMCLIENT_PROFILE`` is set to the output directory, or to
+        ``1`` to use the default directory next to the session path.
+
+        For ``AsyncNSMClient``, open and save operations implemented as
+        coroutines are not profiled.
+
+        """
+        self._profiler = OperationProfiler(directory, top)
+        return self._profiler
+
+    def disable_profiling(self):
+        """Stop profiling operations."""
+        self._profiler = None
+
+    def _profiled(self, op, func, path, client_id):
+        """Return func wrapped by the profiler, if profiling is enabled."""
+        if self._profiler is None:
+            return func
+
+        return partial(self._profiler.run, op, path, client_id, func)
+
+    def start_recording(self, path):
+        """Record all OSC messages sent and received to a trace file.
+
+        Returns the ``TraceRecorder`` instance. Use ``TraceReplayer`` to feed
+        the recorded messages back into a client.
+
+        """
+        self.stop_recording()
+        self._recorder = TraceRecorder(path)
+        return self._recorder
+
+    def stop_recording(self):
+        """Stop recording OSC messages and close the trace file."""
+        recorder, self._recorder = self._recorder, None
+
+        if recorder is not None:
+            recorder.close()
+
+    def _observe_latency(self, op):
+        """Add the time since the current operation started to its histogram.
+        """
+        start, self._op_start = self._op_start, None
+
+        if start is not None:
+            self._metrics.latency[op].observe(time.perf_counter() - start)
+
+    def fileno(self):
+        """Return file descriptor of the client's OSC server socket.
+
+        Used with ``threaded=False`` to watch the socket for incoming messages
+        in the program's own event loop.
+
+        """
+        return self.osc_server.fileno()
+
+    def process_pending(self, timeout=0):
+        """Handle incoming OSC messages and return how many were received.
 
+        Waits up to ``timeout`` seconds for the first message (or blocks until
+        a message arrives, if ``timeout`` is ``None``), then handles all
+        messages, which are pending without waiting.
 
-class NSMClient(abc.ABC):
-    """Abstract base class for NSM client implementations."""
+        Used with ``threaded=False`` to handle NSM messages in the thread of
+        the program's own main loop.
 
-    def __init__(self, name=None, init=True, quit_on_error=True, show_gui=True,
-                 executable=None, timeout=5):
-        """Create an NSMClient instance.
+        """
+        recv = self.osc_server.recv
 
-        It ``init`` is ``True`` (the default), announce the client to the NSM
-        server immediately and thereby join the NSM session.
+        if not recv(None if timeout is None else int(timeout * 1000)):
+            return 0
 
-        If joining a session fails or the ``open_session`` or ``save_session``
-        methods raise an exception, the client program is shut down by calling
-        the ``close`` instance method when ``quit_on_error`` is ``True`` (the
-        default).
+        count = 1
 
-        The remaining keyword arguments are passed to the ``init`` method.
+        while recv(0):
+            count += 1
 
-        If the client *and* the server have the CAP_OPTIONAL_GUI capability and
-        if the ``show_gui`` argument is ``True`` (the default), the client's
-        ``show_gui`` method is called after the NSM session has been joined, or
-        the ``hide_gui`` method if it is ``False``.
+        return count
 
-        If the server does not have the CAP_OPTIONAL_GUI capability, but the
-        client does, the ``show_gui`` method is called unconditionally.
+    def add_handler(self, path, handler=None):
+        """Register a handler for incoming OSC messages with the given path.
+
+        The handler is called with as many of the arguments ``path``,
+        ``args``, ``types`` and ``src`` as its signature accepts. A handler
+        registered for a path replaces any previously registered one, including
+        the built-in handlers for NSM messages.
+
+        If ``handler`` is not given, returns a decorator to register the
+        decorated function::
+
+            @client.add_handler("/nsm/client/my_extension")
+            def handle_my_extension(path, args):
+                ...
 
         """
-        self.name = name
-        self.quit_on_error = quit_on_error
-        self._show_gui = show_gui
+        if handler is None:
+            return partial(self._add_handler_deco, self.add_handler, path)
 
-        # NSM sends SIGTERM to tell the program to quit,
-        # so we install a handler method for this signal
-        signal(SIGTERM, self.handle_sigterm)
+        self._handlers[path] = (handler, _callback_nargs(handler))
+        return handler
 
-        # Create an OSC server instance
-        self.osc_server = osc_server = liblo.ServerThread()
-
-        # Add functions to our osc server that receives from NSM.
-        # NSM Welcome Message
-        osc_server.add_method(MSG_REPLY, None, self.handle_reply)
-        # NSM Error messages
-        osc_server.add_method(MSG_ERROR, None, self.handle_error)
-        osc_server.add_method(MSG_OPEN, None, self.handle_open)
-        osc_server.add_method(MSG_SAVE, None, self.handle_save)
-        osc_server.add_method(MSG_SESSION_LOADED, None,
-                              self.handle_session_loaded)
-        osc_server.add_method(MSG_SHOW_GUI, None,
-                              self.handle_show_gui)
-        osc_server.add_method(MSG_HIDE_GUI, None,
-                              self.handle_hide_gui)
-
-        # register a fallback for unhandled messages
-        osc_server.add_method(None, None, self.handle_unknown)
-
-        # And start the server thread
-        osc_server.start()
+    def add_reply_handler(self, target, handler=None):
+        """Register a handler for ``/reply`` messages for the given target.
 
-        if init:
-            self.init(executable=executable, timeout=timeout, show_gui=showgui)
+        ``target`` is the path of the message the server replies to, i.e. the
+        first argument of the ``/reply`` message. The handler is called with
+        the remaining arguments of the reply message.
 
-    # public API functions
+        If ``handler`` is not given, returns a decorator (see ``add_handler``).
 
-    def init(self, executable=None, timeout=5):
-        """Announce the NSM client to the NSM server.
+        """
+        if handler is None:
+            return partial(self._add_handler_deco, self.add_reply_handler,
+                           target)
 
-        The client tries to get the OSC URL of the server from the ``NSM_URL``
-        environment variable. If it is not set or empty, a ``RuntimeError``
-        exception will be raised.
+        self._reply_handlers[target] = handler
+        return handler
 
-        The ``excutable`` argument sets the name of the executable file of the
-        NSM client reported to the NSM server. If it is not passed or false, it
-        will be determined automatically. In certain situations, e.g. when
-        running the Python client from a shell script via ``exec``, this may
-        not result in the correct or desired value being used, so this
-        parameter allows to override it.
+    @staticmethod
+    def _add_handler_deco(register, path, handler):
+        return register(path, handler)
 
-        ``timeout`` sets the maxiumum time period in seconds, for which the
-        client blocks and waits for the server's reply to its announce message.
-        If the server does not reply within the timeout, a ``RuntimeError``
-        exception is raised.
+    # Internal helper methods
 
+    def announce(self, executable, pid):
+        """Send announcement to server that client wants to be part of session.
         """
+        self._freeze_capabilities()
+        caps = self._announce_caps
+        log.debug("Announcing client: name=%s, capabilities=%s, executable=%s"
+                  ",pid=%i", self.app_name, caps, executable, pid)
+        self.send(MSG_ANNOUNCE, self.app_name, caps, executable,
+                  API_VERSION_MAJOR, API_VERSION_MINOR, pid)
+
+    def _prepare_announce(self, executable=None):
+        """Initialize client state and return executable name to announce."""
         nsm_url = os.getenv("NSM_URL")
 
         if not nsm_url:
@@ -225,116 +2674,321 @@ class NSMClient(abc.ABC):
 
         # We keep the client state in a separate data object
         self.state = ClientState(nsm_url)
-
-        # XXX: Funky!
-        import __main__
+        self._joined = threading.Event()
 
         if not executable:
             # Derrive the executable path from __main__.__file__
-            filename = __main__.__file__
-            if dirname(filename) in os.environ["PATH"].split(os.pathsep):
-                executable = basename(filename)
-            elif filename :
-                executable = abspath(filename)
+            filename = getattr(sys.modules.get('__main__'), '__file__', None)
 
-        # Finally tell NSM we are ready and start the main loop
-        self.announce(executable, os.getpid())
+            if filename:
+                executable = _executable_name(filename,
+                                              os.environ.get("PATH", ""),
+                                              os.getcwd())
 
-        # Wait for the welcome message.
-        if timeout:
-            s = time.time()
-            while not self.state.session_joined:
-                time.sleep(.1)
-                if time.time() - s > timeout:
-                    raise RuntimeError("No response from NSM server within "
-                                       "timeout (%s sec.).", timeout)
+        return executable
 
-    def send_message(self, message, priority=0):
-        """Send a status message to the NSM server.
+    def _start_transport(self):
+        """Create and start the OSC server, unless this was already done."""
+        if self.osc_server is not None:
+            return
 
-        /nsm/client/message i:priority s:message
+        start = time.perf_counter()
+        self.backend = _select_backend(self.backend)
+        start = self._record_timing('backend', start)
 
-        Clients may send miscellaneous status updates to the server for
-        possible display to the user. This may simply be chatter that is
-        normally written to the console. priority should be a number from 0 to
-        3, 3 being the most important. Clients which have this capability
-        should include :message: in their announce capability string.
+        # Create an OSC server instance and start the server thread
+        self.osc_server = self._create_server()
+        self._add_methods(self.osc_server)
+
+        if self.host is not None:
+            self.host.add(self)
+        else:
+            if self.threaded:
+                self.osc_server.start()
+
+            # NSM sends SIGTERM to tell the program to quit,
+            # so we install a handler method for this signal
+            self._install_signal_handler()
+
+        self._record_timing('server', start)
+
+    def _install_signal_handler(self):
+        signal(SIGTERM, self.handle_sigterm)
+
+    def _record_timing(self, step, start):
+        """Store time elapsed since start for startup step and return now."""
+        now = time.perf_counter()
+        self.startup_timings[step] = now - start
+        return now
+
+    def _wait_joined(self, timeout):
+        """Wait for the welcome message and return whether it was received.
+
+        Without an OSC server thread, incoming messages are processed while
+        waiting.
 
         """
-        if "message" in self.capabilities:
-            self.send(MSG_MESSAGE, int(priority), str(message))
+        if self.threaded or self.host is not None:
+            return self._joined.wait(timeout)
+
+        deadline = time.monotonic() + timeout
+
+        while not self._joined.is_set():
+            remaining = deadline - time.monotonic()
+
+            if remaining <= 0:
+                return False
+
+            self.process_pending(remaining)
+
+        return True
+
+    @staticmethod
+    def _announce_waits(start, timeout, retries, retry_interval, backoff):
+        """Yield wait periods between announce resends until the timeout."""
+        interval = retry_interval
+
+        while True:
+            remaining = timeout - (time.monotonic() - start)
+
+            if remaining <= 0:
+                return
+
+            if retries > 0:
+                retries -= 1
+                yield min(interval, remaining)
+                interval *= backoff
+            else:
+                yield remaining
+                return
+
+    def _submit(self, func, args, kwargs, on_done, on_failed):
+        """Run an open or save operation with the executor."""
+        future = self.executor.submit(func, *args, **kwargs)
+        future.add_done_callback(
+            partial(self._operation_done, on_done, on_failed))
+
+    def _schedule_open(self, args):
+        """Start an open operation or queue it after the running one.
+
+        An open request already waiting is superseded and a running open
+        operation is cancelled.
+
+        """
+        superseded = None
+
+        with self._sched_lock:
+            if self._pending_op is None:
+                self._pending_op = MSG_OPEN
+                token = self._open_token = CancellationToken()
+            else:
+                superseded, self._queued_open = self._queued_open, args
+
+                if self._pending_op == MSG_OPEN:
+                    log.debug("Cancelling superseded open operation.")
+                    self._open_token.cancel()
+
+                token = None
+
+        if superseded is not None:
+            self._reject_pending(MSG_OPEN, "Open of '{}' superseded by a newer "
+                                 "open request.".format(superseded[0]))
+
+        if token is not None:
+            self._start_open(args, token)
+
+    def _schedule_save(self):
+        """Start a save operation or queue it after the running save.
+
+        Save requests waiting together are coalesced into one operation.
+
+        """
+        with self._sched_lock:
+            pending = self._pending_op
+
+            if pending is None:
+                self._pending_op = MSG_SAVE
+            elif pending == MSG_SAVE and self._queued_open is None:
+                self._queued_saves += 1
+                return
+
+        if pending is None:
+            self._start_save(1)
         else:
-            log.warning("The client tried to send a status message but was "
-                        "not initialized with the 'message' capability. "
-                        "The message was not sent. Get rid of this warning by "
-                        "setting the 'message' capability flag to True or "
-                        "remove the message update from the code")
+            self._reject_pending(MSG_SAVE, "Cannot save: session is being "
+                                 "opened.")
 
-    def set_dirty(self, dirty, internal=False):
-        """Report state change to NSM server.
+    def _next_operation(self):
+        """Mark the running operation as finished and dequeue the next one.
 
-        /nsm/client/is_dirty
-        /nsm/client/is_clean
+        Returns a function to start the next operation or ``None``. It must be
+        called after the reply for the finished operation has been sent.
 
-        Some clients may be able to inform the server when they have unsaved
-        changes pending. Such clients may optionally send is_dirty and is_clean
-        messages. Clients which have this capability should include :dirty: in
-        their announce capability string.
+        """
+        with self._sched_lock:
+            self._pending_op = None
+            self._open_token = None
+
+            if self._queued_saves:
+                count, self._queued_saves = self._queued_saves, 0
+                self._pending_op = MSG_SAVE
+                return partial(self._start_save, count)
+            elif self._queued_open is not None:
+                args, self._queued_open = self._queued_open, None
+                self._pending_op = MSG_OPEN
+                self._open_token = CancellationToken()
+                return partial(self._start_open, args, self._open_token)
+
+    def _start_open(self, args, token):
+        """Run a scheduled open operation with the executor."""
+        self._op_start = time.perf_counter()
+
+        if self._loading is not None:
+            start_next = self._next_operation()
+            self._reject_pending(MSG_OPEN, "Cannot open session: previous "
+                                 "session is still loading.")
+            if start_next is not None:
+                start_next()
+        elif not self._open_cached(*args):
+            self._submit(self._profiled('open', self.open_session, args[0],
+                                        args[2]),
+                         args, self._open_kwargs(token),
+                         partial(self._open_done, *args), self._open_failed)
+
+    def _start_save(self, requests):
+        """Run a scheduled save operation answering the given number of
+        save requests with the executor.
+        """
+        self._op_start = time.perf_counter()
+        self._start_fingerprint()
+        state = self.state
+        self._submit(self._profiled('save', self.save_session,
+                                    state.session_path, state.client_id),
+                     (state.session_path,), {},
+                     lambda result: self._save_done(requests),
+                     partial(self._save_failed, requests=requests))
+
+    def _open_kwargs(self, token):
+        """Return keyword arguments to pass the token to ``open_session``.
+
+        Returns an empty dict, if ``open_session`` does not accept a
+        ``cancel`` argument.
 
         """
-        if "dirty" in self.capabilities:
-            if dirty and not self.state.dirty:
-                self.state.dirty = True
-                self.send(MSG_DIRTY)
-            elif not dirty and self.state.dirty:
-                self.state.dirty = False
-                self.send(MSG_CLEAN)
-        elif not internal:
-            log.warning("The client tried to send a dirty/clean update, "
-                        "but was not initialized with the 'dirty' capability. "
-                        "The message was not sent. "
-                        "Get rid of this warning by setting the 'dirty' "
-                        "capability flag to True or remove the dirty update "
-                        "from the code.")
+        func = getattr(self.open_session, '__func__', self.open_session)
+        code = getattr(func, '__code__', None)
 
-    def set_label(self, label):
-        """Set the client label in the NSM GUI."""
-        self.send(MSG_LABEL, str(label))
+        if (code is None or 'cancel' not in
+                code.co_varnames[:code.co_argcount + code.co_kwonlyargcount]):
+            return {}
 
-    def update_progress(self, progress):
-        """Report progress update to NSM server.
+        return {'cancel': token}
 
-        /nsm/client/progress f:progress
+    def _reject_pending(self, path, msg):
+        """Answer a request with an ``OPERATION_PENDING`` error."""
+        log.warning(msg)
+        self.send_error(msg, ErrCode.OPERATION_PENDING, path)
 
-        progress must be a float between 0 and 1.0.
+    @staticmethod
+    def _operation_done(on_done, on_failed, future):
+        try:
+            result = future.result()
+        except Exception as exc:
+            on_failed(exc)
+        else:
+            on_done(result)
 
-        For potentially time-consuming operations, such as save and open,
-        progress updates may be reported to the NSM server throughout the
-        duration of the operation, by sending a floating point value between
-        0.0 and 1.0. The value 1.0 indicates completion. The server will not
-        send a response to these messages, but will relay the information to
-        the user.
+    def _create_server(self):
+        """Create and return the OSC server instance used by this client."""
+        if self.backend == BACKEND_UDP:
+            return OSCServerThread() if self.threaded else OSCServer()
+
+        return liblo.ServerThread() if self.threaded else liblo.Server()
+
+    def _add_methods(self, osc_server):
+        """Register the message dispatcher with the given OSC server.
+
+        All incoming messages are passed to ``_dispatch``, which looks up the
+        handler for the message path in the handler table.
 
         """
-        if "progress" in self.capabilities:
-            self.send(MSG_PROGRESS, float(progress))
+        osc_server.add_method(None, None, self._dispatch)
+
+    def _init_unknown_limiter(self):
+        """Set up rate limiting of warnings about unknown messages."""
+        self._unknown_limiter = _RateLimiter(
+            self.unknown_log_limit, self.unknown_log_interval,
+            on_suppressed=self._log_unknown_suppressed)
+
+    def _init_dispatch(self):
+        """Set up the handler tables for incoming messages and replies."""
+        self._handlers = {}
+        self._reply_handlers = {}
+        self.add_handler(MSG_REPLY, self.handle_reply)
+        self.add_handler(MSG_ERROR, self.handle_error)
+        self.add_handler(MSG_OPEN, self.handle_open)
+        self.add_handler(MSG_SAVE, self.handle_save)
+        self.add_handler(MSG_SESSION_LOADED, self.handle_session_loaded)
+        self.add_handler(MSG_SHOW_GUI, self.handle_show_gui)
+        self.add_handler(MSG_HIDE_GUI, self.handle_hide_gui)
+        self.add_reply_handler(MSG_ANNOUNCE, self.handle_welcome)
+        self.add_reply_handler(MSG_OPENED,
+                               lambda *args: log.info("Session loaded."))
+        self.add_reply_handler(MSG_SAVED,
+                               lambda *args: log.info("Session saved."))
+
+    def _dispatch(self, path, args, types, src):
+        """Call the handler registered for the path of an incoming message."""
+        try:
+            handler, nargs = self._handlers[path]
+        except KeyError:
+            handler, nargs = self.handle_unknown, 4
+            # Don't let arbitrary paths grow the counters without bounds
+            self._metrics.count(self._metrics.received, _UNKNOWN_PATH)
         else:
-            log.warning("The client tried to send a progress update but was "
-                        "not initialized with the 'progress' capability. "
-                        "The message was not sent. Get rid of this warning by "
-                        "setting the 'progress' capability flag or remove the "
-                        "progress update from the code.")
+            self._metrics.count(self._metrics.received, path)
 
-    # Internal helper methods
+            # Open and save operations are profiled separately. Unknown
+            # messages aren't profiled, so arbitrary paths don't create files.
+            if (self._profiler is not None and
+                    path not in (MSG_OPEN, MSG_SAVE)):
+                handler = self._profiled('handle' + path, handler,
+                                         self.state.session_path,
+                                         self.state.client_id)
+
+        if self._tracer is not None:
+            self._tracer(TRACE_IN, path, args)
+
+        recorder = self._recorder
+
+        if recorder is None:
+            handler(*(path, args, types, src)[:nargs])
+        else:
+            start = time.monotonic()
+            # Recorded before messages sent by the handler
+            pos = recorder.write(TRACE_IN, start, 0.0, path, args, types)
+
+            try:
+                handler(*(path, args, types, src)[:nargs])
+            finally:
+                if pos is not None:
+                    recorder.set_duration(pos, time.monotonic() - start)
+
+    def _freeze_capabilities(self):
+        """Store client capabilities and the announce capability string."""
+        self._caps = frozenset(self.capabilities)
+        self._announce_caps = ":".join([''] + list(self.capabilities) + [''])
+
+    def _has_capability(self, capability):
+        """Return whether the client has the given capability.
+
+        Uses the capabilities stored when the client was announced, or the
+        ``capabilities`` property, if it was not announced yet.
 
-    def announce(self, executable, pid):
-        """Send announcement to server that client wants to be part of session.
         """
-        caps = ":".join([''] + list(self.capabilities) + [''])
-        log.debug("Announcing client: name=%s, capabilities=%s, executable=%s"
-                  ",pid=%i", self.app_name, caps, executable, pid)
-        self.send(MSG_ANNOUNCE, self.app_name, caps, executable,
-                  API_VERSION_MAJOR, API_VERSION_MINOR, pid)
+        caps = self._caps
+        return capability in (caps if caps is not None
+                              else self.capabilities)
 
     def close(self):
         """Call the quit callback and then quit the program.
@@ -343,20 +2997,39 @@ class NSMClient(abc.ABC):
         itself. It should just shut down audio engines etc.
 
         Even if the callback function does nothing, the client process will
-        still quit.
+        still quit, unless the client is run by a ``NSMClientHost``. In this
+        case, only this client is shut down and removed from the host.
 
         """
         # This can go wrong if the quit callback function tries to
         # shutdown things which have not been initialized yet.
         # For example the JACK engine which is by definition started
         # AFTER nsm-open
+        if self.host is not None:
+            log.debug("Hosted client shutdown.")
+            self.quit()
+            self.host.remove(self)
+            return
+
+        if threading.current_thread() is not threading.main_thread():
+            # Let the SIGTERM handler shut down the client in the main thread
+            log.debug("Requesting client shutdown from main thread.")
+            os.kill(os.getpid(), SIGTERM)
+            return
+
         log.debug("Client shutdown.")
         self.quit()
-        self.osc_server.stop()
+
+        if self.osc_server is None:
+            pass
+        elif self.threaded:
+            self.osc_server.stop()
+        else:
+            self.osc_server.free()
+
         sys.exit()
         log.debug("I'm a zombie.")
 
-
     def send(self, *args, **kwargs):
         """Send an OSC mesage to the NSM server.
 
@@ -365,14 +3038,57 @@ class NSMClient(abc.ABC):
         the source.
 
         """
-        log.debug("Sending OSC to '%s': %r %r",
-                  self.state.nsm_url, args, kwargs)
+        batch = getattr(self._local, 'batch', None)
+
+        if batch is not None:
+            batch.add(args)
+            return
+
+        if self.osc_server is None:
+            log.debug("No OSC server, message not sent: %r", args)
+            return
+
+        self._metrics.count(self._metrics.sent, args[0])
+
+        if self._recorder is not None:
+            self._recorder.write(TRACE_OUT, time.monotonic(), 0.0, args[0],
+                                 args[1:])
+
+        if self._tracer is not None:
+            self._tracer(TRACE_OUT, args[0], args[1:])
+
         self.osc_server.send(self.state.nsm_url, *args, **kwargs)
 
+    def _send_bundle(self, messages):
+        """Send messages to the NSM server as one OSC bundle."""
+        if self.osc_server is None:
+            log.debug("No OSC server, bundle not sent: %r", messages)
+            return
+
+        recorder = self._recorder
+        tracer = self._tracer
+        now = time.monotonic()
+
+        for msg in messages:
+            self._metrics.count(self._metrics.sent, msg[0])
+
+            if recorder is not None:
+                recorder.write(TRACE_OUT, now, 0.0, msg[0], msg[1:])
+
+            if tracer is not None:
+                tracer(TRACE_OUT, msg[0], msg[1:])
+
+        if self.backend == BACKEND_UDP:
+            self.osc_server.send_bundle(self.state.nsm_url, messages)
+        else:
+            self.osc_server.send(self.state.nsm_url, liblo.Bundle(
+                *[liblo.Message(*msg) for msg in messages]))
+
     def send_error(self, msg, code=ErrCode.GENERAL, path=MSG_ANNOUNCE):
         """Send an error reply message to the NSM server."""
+        self._metrics.count(self._metrics.errors_sent, _error_name(code))
         # make sure we send a number.
-        self.send(MSG_ERROR, path, code, msg)
+        self.send(MSG_ERROR, path, int(getattr(code, 'value', code)), msg)
 
     # OSC message, signal handler and internal callback functions
 
@@ -381,73 +3097,221 @@ class NSMClient(abc.ABC):
 
         /error "/nsm/server/announce" i:error_code s:error_message
 
-        ErrCode.GENERAL           General Error
-        ErrCode.INCOMPATIBLE_API  Incompatible API version
-        ErrCode.BLACKLISTED       Client has been blacklisted.
+        ErrCode.GENERAL           General Error
+        ErrCode.INCOMPATIBLE_API  Incompatible API version
+        ErrCode.BLACKLISTED       Client has been blacklisted.
+
+        """
+        path, err_code, msg = args
+        quit = self.quit_on_error
+        self._metrics.count(self._metrics.errors_received,
+                            _error_name(err_code))
+
+        try:
+            msg = _ERROR_MESSAGES[err_code]
+        except KeyError:
+            # XXX: call custom error handler if defined?
+            msg = ("Client received error %s but does't know how to handle it:"
+                   " %s" % (err_code, msg))
+
+        if path == MSG_ANNOUNCE:
+            quit = True
+            msg = "Server rejected client announcement: " + msg
+
+        log.error(msg)
+
+        if quit:
+            log.debug("Client shuts itself down.")
+            self.close()
+
+    def handle_open(self, path, args, types):
+        """Handle open message received from NSM server.
+
+        /nsm/client/open s:instance_specific_path_to_project s:session_name
+                         s:client_id
+
+        A response is REQUIRED as soon as the open operation has been
+        completed. Ongoing progress may be indicated by sending messages to
+        /nsm/client/progress.
+
+        """
+        log.debug("open message received: %s %r", path, args)
+        session_prefix, session_name, client_id = args
+
+        if self._loading is not None:
+            self._reject_pending(MSG_OPEN, "Cannot open session: previous "
+                                 "session is still loading.")
+            return
+
+        if self.executor is not None:
+            self._schedule_open(args)
+            return
+
+        self._op_start = time.perf_counter()
+
+        if self._open_cached(*args):
+            return
+
+        # Call the open callback function
+        try:
+            open_session = self._profiled('open', self.open_session,
+                                          session_prefix, client_id)
+            session_path = open_session(
+                session_prefix, session_name, client_id,
+                **self._open_kwargs(CancellationToken()))
+        except Exception as exc:
+            self._open_failed(exc)
+        else:
+            self._open_done(session_prefix, session_name, client_id,
+                            session_path)
+
+    def _open_cached(self, session_prefix, session_name, client_id):
+        """Restore session from the session cache, if possible.
+
+        Before switching to another session, the state of the current session
+        is stored in the cache. Returns ``True`` if the requested session was
+        restored from the cache and the reply has been sent.
+
+        """
+        cache = self.session_cache
+
+        if cache is None or not self._has_capability(CAP_SWITCH):
+            return False
+
+        state = self.state
+
+        if state.session_path is not None and not state.dirty:
+            # Failing to cache the current session must not fail the open
+            try:
+                session_state = self.get_session_state()
+
+                if session_state is not None:
+                    cache.put((state.session_prefix, state.client_id),
+                              session_state, state.session_path,
+                              self.session_state_size(session_state))
+            except Exception:
+                log.exception("Could not store session in cache.")
+
+        # The entry is removed, because the restored state will be modified
+        # and must not be restored again when switching back later.
+        entry = cache.pop((session_prefix, client_id))
+
+        if entry is None:
+            return False
+
+        log.debug("Restoring session '%s' from cache.", entry.session_path)
+
+        try:
+            self.restore_session_state(entry.state)
+        except Exception:
+            log.exception("Could not restore session from cache.")
+            return False
+
+        self._open_done(session_prefix, session_name, client_id,
+                        entry.session_path)
+        return True
+
+    def _open_done(self, session_prefix, session_name, client_id,
+                   session_path):
+        """Update client state and reply after a successful open."""
+        deferred = None
+
+        if isinstance(session_path, DeferredOpen):
+            deferred = session_path
+            session_path = deferred.session_path
+
+        state = self.state
+        state.session_prefix = session_prefix
+        state.session_name = session_name
+        state.client_id = client_id
+
+        if not session_path.startswith(state.session_prefix):
+            session_path = state.session_prefix + session_path
 
-        """
-        path, err_code, msg = args
-        quit = self.quit_on_error
+        self.state.session_path = session_path
+        self._saved_path = None
+        self._load_failed = False
+        self._observe_latency('open')
 
-        if err_code == ErrCode.INCOMPATIBLE_API:
-            msg = "Incompatible API."
-        elif err_code == ErrCode.BLACKLISTED:
-            msg = "Client black listed."
-        elif err_code == ErrCode.GENERAL:
-            msg = "General error."
-        else:
-            # XXX: call custom error handler if defined?
-            msg = ("Client received error %s but does't know how to handle it:"
-                   " %s" % (err_code, msg))
+        if deferred is not None:
+            # Must be set before replying, so that a save request sent by the
+            # server in response to the reply is held back.
+            self._loading = deferred
 
-        if path == MSG_ANNOUNCE:
-            quit = True
-            msg = "Server rejected client announcement: " + msg
+        start_next = self._next_operation()
+        self.send(MSG_REPLY, MSG_OPEN,
+                  "'{}' successfully opened".format(session_path))
 
-        log.error(msg)
+        if deferred is not None:
+            self._start_deferred_load(deferred)
 
-        if quit:
-            log.debug("Client shuts itself down.")
-            self.close()
+        if start_next is not None:
+            start_next()
 
-    def handle_open(self, path, args, types):
-        """Handle open message received from NSM server.
+    def _start_deferred_load(self, deferred):
+        """Run the load function of a ``DeferredOpen`` in a thread."""
+        thread = threading.Thread(target=self._run_deferred_load,
+                                  args=(deferred,), daemon=True,
+                                  name="NSMClientDeferredLoad")
+        thread.start()
 
-        /nsm/client/open s:instance_specific_path_to_project s:session_name
-                         s:client_id
+    def _deferred_progress(self):
+        """Return progress reporter passed to ``DeferredOpen.load``."""
+        if self._has_capability(CAP_PROGRESS):
+            return self.progress()
 
-        A response is REQUIRED as soon as the open operation has been
-        completed. Ongoing progress may be indicated by sending messages to
-        /nsm/client/progress.
+        return ProgressReporter(None)
 
-        """
-        log.debug("open message received: %s %r", path, args)
-        session_prefix, session_name, client_id = args
+    def _run_deferred_load(self, deferred):
+        progress = self._deferred_progress()
 
-        # Call the open callback function
         try:
-            session_path = self.open_session(session_prefix, session_name,
-                                             client_id)
+            deferred.load(progress)
         except Exception as exc:
-            err_code = getattr(exc, 'code', ErrCode.GENERAL)
-            msg = "Session not loaded. Error ({}): {}".format(err_code, exc)
+            self._deferred_load_done(exc)
+        else:
+            progress.finish()
+            self._deferred_load_done()
+
+    def _deferred_load_done(self, exc=None):
+        """Carry out a held back save request after background loading."""
+        with self._load_lock:
+            self._loading = None
+            self._load_failed = exc is not None
+            held_saves, self._held_saves = self._held_saves, 0
+
+        if exc is not None:
+            msg = "Session not loaded completely. Error: {}".format(exc)
             log.error(msg)
-            self.send_error(msg, err_code, MSG_OPEN)
 
-            if self.quit_on_error:
-                self.close()
+            if self._has_capability(CAP_MESSAGE):
+                self.send_message(msg, priority=3)
         else:
-            state = self.state
-            state.session_prefix = session_prefix
-            state.session_name = session_name
-            state.client_id = client_id
+            log.debug("Session loaded completely.")
+
+        # Every request must be answered. In executor mode, they are
+        # coalesced into one save operation.
+        for i in range(held_saves):
+            self.handle_save(MSG_SAVE, (), "")
+
+        if exc is not None and self.quit_on_error:
+            self.close()
+
+    def _open_failed(self, exc):
+        """Report an exception raised by ``open_session`` to the server."""
+        self._observe_latency('open')
+        start_next = self._next_operation()
+        err_code = getattr(exc, 'code', ErrCode.GENERAL)
+        msg = "Session not loaded. Error ({}): {}".format(err_code, exc)
 
-            if not session_path.startswith(state.session_prefix):
-                session_path = state.session_prefix + session_path
+        cancelled = isinstance(exc, OperationCancelled)
+        log.log(logging.WARNING if cancelled else logging.ERROR, msg)
+        self.send_error(msg, err_code, MSG_OPEN)
 
-            self.state.session_path = session_path
-            self.send(MSG_REPLY, MSG_OPEN,
-                      "'{}' successfully opened".format(session_path))
+        if self.quit_on_error and not cancelled:
+            self.close()
+        elif start_next is not None:
+            start_next()
 
     def handle_reply(self, path, args, types):
         """Handle /reply messages received from NSM server.
@@ -459,14 +3323,12 @@ class NSMClient(abc.ABC):
         if not args:
             return
 
-        if args[0] == MSG_ANNOUNCE:
-            self.handle_welcome(*args[1:])
-        elif args[0] == MSG_OPENED:
-            log.info("Session loaded.")
-        elif args[0] == MSG_SAVED:
-            log.info("Session saved.")
-        else:
+        try:
+            handler = self._reply_handlers[args[0]]
+        except KeyError:
             log.warning("Unknown /reply message: %r", args)
+        else:
+            handler(*args[1:])
 
     def handle_save(self, path, args, types):
         """Handle save message received from NSM server.
@@ -482,23 +3344,153 @@ class NSMClient(abc.ABC):
         """
         log.debug("save message received: %s %r", path, args)
 
+        if self._hold_save() or self._reject_save() or self._skip_save():
+            return
+
+        if self.executor is not None:
+            self._schedule_save()
+            return
+
+        self._op_start = time.perf_counter()
+        self._start_fingerprint()
+
         # Call the save callback function
         try:
-            self.save_session(self.state.session_path)
+            state = self.state
+            self._profiled('save', self.save_session, state.session_path,
+                           state.client_id)(state.session_path)
         except Exception as exc:
-            err_code = getattr(exc, 'code', ErrCode.GENERAL)
-            msg = "Not saved. Error ({}): {}".format(err_code, exc)
+            self._save_failed(exc)
+        else:
+            self._save_done()
+
+    def _hold_save(self):
+        """Hold back a save request while the session is still loading.
+
+        Returns ``True`` if the save will be carried out later.
+
+        """
+        with self._load_lock:
+            if self._loading is not None:
+                log.debug("Session still loading, holding back save request.")
+                self._held_saves += 1
+                return True
+
+        return False
+
+    def _reject_save(self):
+        """Refuse to save a session, which could not be loaded completely.
+
+        Returns ``True`` if the save was rejected.
+
+        """
+        if self._load_failed:
+            msg = "Not saved: session was not loaded completely."
             log.error(msg)
-            self.send_error(msg, err_code, MSG_SAVE)
+            self.save_stats['failed'] += 1
+            self.send_error(msg, ErrCode.GENERAL, MSG_SAVE)
+            return True
+
+        return False
 
-            if self.quit_on_error:
-                self.close()
+    def _skip_save(self):
+        """Reply to a save request immediately if the session is unchanged.
+
+        Returns ``True`` if the save was skipped.
+
+        """
+        if not self.skip_unchanged_saves or self._pending_op is not None:
+            return False
+
+        session_path = self.state.session_path
+        saved = self._saved_path == session_path
+
+        if (saved and self._has_capability(CAP_DIRTY) and
+                not self.state.dirty):
+            reason = 'skipped_clean'
         else:
-            self.send(MSG_REPLY, MSG_SAVE, "'{}' successfully saved."
-                      .format(self.state.session_path))
+            fingerprint = self._session_fingerprint()
+
+            if (saved and fingerprint is not None and
+                    fingerprint == self._saved_fingerprint):
+                reason = 'skipped_unchanged'
+            else:
+                return False
+
+        log.debug("Session unchanged since last save, skipping save (%s).",
+                  reason)
+        self.save_stats[reason] += 1
+
+        with self.batch():
+            self.send(MSG_REPLY, MSG_SAVE, "'{}' unchanged, not saved again."
+                      .format(session_path))
+            self.set_dirty(False, internal=True)
+        return True
+
+    def _session_fingerprint(self):
+        """Return ``session_fingerprint()`` or ``None`` if it fails.
+
+        A failing fingerprint must not prevent saving, so errors are only
+        logged.
+
+        """
+        try:
+            return self.session_fingerprint()
+        except Exception:
+            log.exception("Could not compute session fingerprint.")
+
+    def _start_fingerprint(self):
+        """Compute the fingerprint of the session a save is starting for.
+
+        It becomes the fingerprint of the last save when the save succeeds.
+
+        """
+        self._next_fingerprint = (self._session_fingerprint()
+                                  if self.skip_unchanged_saves else None)
+
+    def _save_done(self, requests=1):
+        """Reply to the server and mark the client clean after a save.
+
+        ``requests`` is the number of (coalesced) save requests to answer.
+
+        """
+        self._observe_latency('save')
+        start_next = self._next_operation()
+        self.save_stats['saved'] += 1
+        self.save_stats['coalesced'] += requests - 1
+        self._saved_path = self.state.session_path
+        self._saved_fingerprint = self._next_fingerprint
+
+        with self.batch():
+            for i in range(requests):
+                self.send(MSG_REPLY, MSG_SAVE, "'{}' successfully saved."
+                          .format(self.state.session_path))
+
             self.set_dirty(False, internal=True)
 
-    def handle_session_loaded(self):
+        if start_next is not None:
+            start_next()
+
+    def _save_failed(self, exc, requests=1):
+        """Report an exception raised by ``save_session`` to the server."""
+        self._observe_latency('save')
+        start_next = self._next_operation()
+        self.save_stats['failed'] += 1
+        self.save_stats['coalesced'] += requests - 1
+        self._saved_path = None
+        err_code = getattr(exc, 'code', ErrCode.GENERAL)
+        msg = "Not saved. Error ({}): {}".format(err_code, exc)
+        log.error(msg)
+
+        for i in range(requests):
+            self.send_error(msg, err_code, MSG_SAVE)
+
+        if self.quit_on_error:
+            self.close()
+        elif start_next is not None:
+            start_next()
+
+    def handle_session_loaded(self, *args):
         """Handle session_is_loaded received from NSM server.
 
         /nsm/client/session_is_loaded
@@ -510,13 +3502,36 @@ class NSMClient(abc.ABC):
         """Handle system signal SIGTERM by shutting down client orderly."""
         self.close()
 
+    def _log_unknown_suppressed(self, path, count):
+        if path is None:
+            log.warning("%i unknown OSC messages to other paths suppressed.",
+                        count)
+        else:
+            log.warning("%i unknown OSC messages to '%s' suppressed.",
+                        count, path)
+
     def handle_unknown(self, path, args, types, src):
-        """Handle unknown OSC messages."""
+        """Handle unknown OSC messages.
+
+        Warnings are logged for at most ``unknown_log_limit`` messages per
+        path within ``unknown_log_interval`` seconds. The number of further
+        messages is logged when the interval ends.
+
+        """
+        metrics = self._metrics
+        metrics.unknown += 1
+        allowed, _ = self._unknown_limiter.check(path)
+
+        if not allowed:
+            metrics.unknown_suppressed += 1
+            return
+
         log.warning("Received unknown OSC message '%s' from '%s'",
-                    path, src.get_url())
+                    path, src.get_url() if src is not None else None)
 
-        for a, t in zip(args, types):
-            log.debug("argument of type '%s': %r", t, a)
+        if log.isEnabledFor(logging.DEBUG):
+            for a, t in zip(args, types):
+                log.debug("argument of type '%s': %r", t, a)
 
     def handle_welcome(self, welcome_msg, nsm_name, capabilities):
         """Handle welcome message received from NSM server.
@@ -527,30 +3542,56 @@ class NSMClient(abc.ABC):
         Receiving this message means we are now part of a session.
 
         """
+        if self.state.session_joined:
+            log.debug("Ignoring repeated welcome message.")
+            return
+
         self.state.session_joined = True
         self.state.welcome_msg = welcome_msg
         self.state.nsm_name = nsm_name
         self.state.server_capabilities = set(
             capabilities.strip(':').split(':'))
+        self._joined.set()
 
         # If the optional-gui capability is not present then clients with
         # optional GUIs MUST always keep them visible
-        if CAP_OPTIONAL_GUI in self.capabilities:
+        if self._has_capability(CAP_OPTIONAL_GUI):
             if CAP_OPTIONAL_GUI in self.state.server_capabilities:
-                if self._show_gui:
-                    self.show_gui()
-                    self.send(MSG_GUI_SHOWN)
-                else:
-                    self.hide_gui()
-                    self.send(MSG_GUI_HIDDEN)
+                self._dispatch_gui(self._show_gui)
             else:
                 # Call show_gui once.
                 # All other OSC messages from client will be ignored.
-                self.show_gui()
-                self.send(MSG_GUI_SHOWN)
+                self._dispatch_gui(True)
 
     # GUI
 
+    def _dispatch_gui(self, show):
+        """Call show_gui or hide_gui via the GUI dispatcher."""
+        dispatcher = self.gui_dispatcher
+
+        if dispatcher is None:
+            self._call_gui(show, None)
+        else:
+            dispatcher.call_soon(partial(self._call_gui, show, dispatcher))
+
+    def _call_gui(self, show, dispatcher):
+        """Call show_gui or hide_gui and report the GUI state to the server.
+        """
+        if show:
+            func, msg = self.show_gui, MSG_GUI_SHOWN
+        else:
+            func, msg = self.hide_gui, MSG_GUI_HIDDEN
+
+        try:
+            func()
+        except Exception:
+            log.exception("Error in '%s()' method.", func.__name__)
+        else:
+            if dispatcher is None:
+                self.send(msg)
+            else:
+                dispatcher.call_when_idle(partial(self.send, msg))
+
     def handle_hide_gui(self, *args):
         """Handle hide_optional_gui message received from NSM server.
 
@@ -558,13 +3599,8 @@ class NSMClient(abc.ABC):
         optional GUIs. If not, ignore command.
 
         """
-        if "optional-gui" in self.state.server_capabilities:
-            try:
-                self.hide_gui()
-            except:
-                log.exception("Error in 'hide_gui()' method.")
-            else:
-                self.send(MSG_GUI_HIDDEN)
+        if CAP_OPTIONAL_GUI in self.state.server_capabilities:
+            self._dispatch_gui(False)
         else:
             log.warning("%s message received but server capabilities do not "
                         "include 'optional-gui'.", MSG_HIDE_GUI)
@@ -576,13 +3612,8 @@ class NSMClient(abc.ABC):
         optional GUIs. If not, ignore command.
 
         """
-        if "optional-gui" in self.state.server_capabilities:
-            try:
-                self.show_gui()
-            except:
-                log.exception("Error in 'show_gui()' method.")
-            else:
-                self.send(MSG_GUI_SHOWN)
+        if CAP_OPTIONAL_GUI in self.state.server_capabilities:
+            self._dispatch_gui(True)
         else:
             log.warning("%s message received but server capabilities do not "
                         "include 'optional-gui'.", MSG_SHOW_GUI)
@@ -632,6 +3663,52 @@ class NSMClient(abc.ABC):
 
     # Optional methods, may be overwritten by sub-classes
 
+    def session_fingerprint(self):
+        """Return a digest of the current session state or ``None``.
+
+        Used to detect unchanged sessions, if the client was created with
+        ``skip_unchanged_saves=True``. The value can be any object supporting
+        equality comparison, e.g. a hash of the client's project data. It
+        should be cheap to compute compared to saving the session. The
+        default implementation returns ``None``, which disables the check.
+
+        """
+        return None
+
+    def get_session_state(self):
+        """Return the in-memory state of the currently open session.
+
+        Used to store the session state in the session cache before switching
+        to another session (see the ``session_cache`` constructor argument).
+        The returned object is passed to ``restore_session_state``, when the
+        client switches back to the session later. It must not be modified by
+        the client afterwards. Return ``None`` to not cache the session.
+
+        The default implementation returns ``None``.
+
+        """
+        return None
+
+    def restore_session_state(self, state):
+        """Restore session state returned earlier by ``get_session_state``.
+
+        Called instead of ``open_session`` when switching back to a session
+        found in the session cache.
+
+        """
+        raise NotImplementedError
+
+    def session_state_size(self, state):
+        """Return approximate memory size in bytes of cached session state.
+
+        Used by the session cache to limit its memory usage. Must be
+        overridden, if the cache has a ``max_bytes`` limit, since only the
+        client knows how much memory its session state uses. The default
+        implementation returns 0.
+
+        """
+        return 0
+
     def hide_gui(self):
         """Called when NSM tells the client to close its GUI."""
         if CAP_OPTIONAL_GUI not in self.capabilities:
@@ -651,3 +3728,401 @@ class NSMClient(abc.ABC):
         if CAP_OPTIONAL_GUI not in self.capabilities:
             raise RuntimeError(
                 "Client does not have 'optional-gui' capability.")
+
+
+class AsyncNSMClient(NSMClient):
+    """Abstract base class for NSM clients running in an asyncio event loop.
+
+    Works like ``NSMClient``, but instead of using a separate OSC server
+    thread, the OSC server socket is watched by the event loop and incoming
+    NSM messages are handled by loop callbacks.
+
+    The ``init`` method is a coroutine and must be awaited. ``open_session``,
+    ``save_session`` and ``quit`` may be implemented either as normal methods
+    or as coroutines. While an open or save operation is awaited, other
+    incoming messages are still processed. Open and save operations are
+    executed one after another in the order in which they were received.
+
+    """
+
+    def __init__(self, name=None, quit_on_error=True, show_gui=True,
+                 loop=None, backend=None, skip_unchanged_saves=False,
+                 session_cache=None, gui_dispatcher=None):
+        """Create an AsyncNSMClient instance.
+
+        Unlike ``NSMClient``, the client is never announced to the NSM server
+        on instantiation. Await the ``init`` method from a coroutine running in
+        the event loop to join the NSM session.
+
+        ``loop`` is the event loop to use. If not given, the running event loop
+        at the time ``init`` is called will be used.
+
+        See the docstring of ``NSMClient.__init__`` for the meaning of the
+        other arguments.
+
+        """
+        super().__init__(name=name, init=False, quit_on_error=quit_on_error,
+                         show_gui=show_gui, backend=backend,
+                         skip_unchanged_saves=skip_unchanged_saves,
+                         threaded=False, session_cache=session_cache,
+                         gui_dispatcher=gui_dispatcher)
+        self._loop = loop
+        self._welcome = None
+        self._op_lock = None
+        self._tasks = set()
+        # Token of the most recent open request
+        self._latest_open = None
+
+    async def init(self, executable=None, timeout=5, retries=0,
+                   retry_interval=0.5, backoff=2.0):
+        """Announce the NSM client to the NSM server.
+
+        Attaches the OSC server to the event loop, sends the announce message
+        and waits without blocking the event loop for the server's reply.
+
+        See the docstring of ``NSMClient.init`` for the meaning of the
+        arguments and the return value.
+
+        """
+        # Imported here, since importing asyncio takes about 20 ms, which
+        # programs not using this class should not have to pay
+        import asyncio
+
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+
+        executable = self._prepare_announce(executable)
+        self._start_transport()
+        self._op_lock = asyncio.Lock()
+        self._welcome = self._loop.create_future()
+        start = time.perf_counter()
+        sent = time.monotonic()
+        self.announce(executable, os.getpid())
+        start = self._record_timing('announce', start)
+
+        if not timeout:
+            return None
+
+        for wait in self._announce_waits(sent, timeout, retries,
+                                         retry_interval, backoff):
+            try:
+                await asyncio.wait_for(asyncio.shield(self._welcome), wait)
+            except asyncio.TimeoutError:
+                if time.monotonic() - sent < timeout:
+                    log.debug("No reply to announce yet, resending.")
+                    self.announce(executable, os.getpid())
+            else:
+                self._record_timing('handshake', start)
+                latency = time.monotonic() - sent
+                self._metrics.latency['announce'].observe(latency)
+                return latency
+
+        raise RuntimeError("No response from NSM server within "
+                           "timeout (%s sec.)." % timeout)
+
+    def close(self):
+        """Call the quit callback and then quit the program.
+
+        If ``quit`` is a coroutine, it is scheduled as a task in the event
+        loop and the program is quit when it has finished.
+
+        """
+        log.debug("Client shutdown.")
+        result = self.quit()
+
+        if _isawaitable(result):
+            self._spawn(self._finish_close(result))
+        else:
+            self._shutdown()
+
+    # Internal helper methods
+
+    def _start_transport(self):
+        """Create the OSC server and watch its socket in the event loop."""
+        if self.osc_server is None:
+            super()._start_transport()
+            self._loop.add_reader(self.osc_server.fileno(),
+                                  self._process_messages)
+
+    def _install_signal_handler(self):
+        # NSM sends SIGTERM to tell the program to quit
+        try:
+            self._loop.add_signal_handler(SIGTERM, self.close)
+        except (NotImplementedError, RuntimeError):
+            signal(SIGTERM, self.handle_sigterm)
+
+    def _process_messages(self):
+        """Dispatch all OSC messages pending on the server socket."""
+        while self.osc_server.recv(0):
+            pass
+
+    def _spawn(self, coro):
+        """Run coroutine as a task and keep a reference until it is done."""
+        task = self._loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _finish_close(self, result):
+        await result
+        self._shutdown()
+
+    def _shutdown(self):
+        if self.osc_server is not None:
+            self._loop.remove_reader(self.osc_server.fileno())
+            self.osc_server.free()
+            self.osc_server = None
+
+        sys.exit()
+
+    async def _open(self, session_prefix, session_name, client_id, token):
+        async with self._op_lock:
+            if token.cancelled:
+                # Superseded while waiting for the running operation
+                self._open_failed(OperationCancelled())
+                return
+
+            self._op_start = time.perf_counter()
+
+            if self._open_cached(session_prefix, session_name, client_id):
+                return
+
+            try:
+                session_path = self.open_session(
+                    session_prefix, session_name, client_id,
+                    **self._open_kwargs(token))
+                if _isawaitable(session_path):
+                    session_path = await session_path
+            except Exception as exc:
+                self._open_failed(exc)
+            else:
+                self._open_done(session_prefix, session_name, client_id,
+                                session_path)
+
+                # Keep holding the lock while loading, so that queued
+                # operations are carried out afterwards.
+                if self._loading is not None:
+                    await self._deferred_load(self._loading)
+
+    def _start_deferred_load(self, deferred):
+        # Loading is awaited by _open
+        pass
+
+    async def _deferred_load(self, deferred):
+        """Run the (possibly asynchronous) load function of a DeferredOpen.
+
+        Normal functions are run in the default executor of the event loop.
+
+        """
+        progress = self._deferred_progress()
+
+        try:
+            if _iscoroutinefunction(deferred.load):
+                await deferred.load(progress)
+            else:
+                await self._loop.run_in_executor(None, deferred.load,
+                                                 progress)
+        except Exception as exc:
+            self._deferred_load_done(exc)
+        else:
+            progress.finish()
+            self._deferred_load_done()
+
+    async def _save(self):
+        async with self._op_lock:
+            if self._reject_save():
+                return
+
+            self._op_start = time.perf_counter()
+            self._start_fingerprint()
+
+            try:
+                result = self.save_session(self.state.session_path)
+                if _isawaitable(result):
+                    await result
+            except Exception as exc:
+                self._save_failed(exc)
+            else:
+                self._save_done()
+
+    # OSC message handlers
+
+    def handle_open(self, path, args, types):
+        """Handle open message received from NSM server.
+
+        Schedules the (possibly asynchronous) ``open_session`` callback as a
+        task in the event loop. The reply is sent when it has completed.
+
+        Earlier open requests, which are still running or waiting, are
+        cancelled.
+
+        """
+        log.debug("open message received: %s %r", path, args)
+
+        if self._latest_open is not None:
+            self._latest_open.cancel()
+
+        token = self._latest_open = CancellationToken()
+        self._spawn(self._open(*args, token))
+
+    def handle_save(self, path, args, types):
+        """Handle save message received from NSM server.
+
+        Schedules the (possibly asynchronous) ``save_session`` callback as a
+        task in the event loop. The reply is sent when it has completed.
+
+        """
+        log.debug("save message received: %s %r", path, args)
+
+        if not self._skip_save():
+            self._spawn(self._save())
+
+    def handle_welcome(self, welcome_msg, nsm_name, capabilities):
+        """Handle welcome message and wake up the waiting ``init`` call."""
+        super().handle_welcome(welcome_msg, nsm_name, capabilities)
+
+        if self._welcome is not None and not self._welcome.done():
+            self._welcome.set_result(welcome_msg)
+
+
+class NSMClientHost(object):
+    """Run many NSM clients in one process with a shared receive thread.
+
+    Pass the host instance to the constructor of each ``NSMClient`` via the
+    ``host`` argument. Hosted clients do not start their own OSC server
+    thread. Instead, a single thread of the host waits for incoming messages
+    for all clients and dispatches them to the client they were sent to.
+
+    The NSM server identifies clients by the network address they send
+    messages from, so each client still has its own (non-threaded) OSC server
+    socket.
+
+    The host installs a single ``SIGTERM`` handler, which closes all clients
+    and then exits the program. Closing a single hosted client only removes
+    it from the host.
+
+    Example::
+
+        host = NSMClientHost()
+        clients = [MyPluginClient(name=name, host=host) for name in names]
+        ...
+        host.close()
+
+    """
+
+    def __init__(self, install_sigterm=True):
+        self.clients = []
+        self._servers = {}
+        self._closing = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self._wakeup = None
+
+        if install_sigterm:
+            # NSM sends SIGTERM to tell the program to quit
+            signal(SIGTERM, self.handle_sigterm)
+
+    def add(self, client):
+        """Add client to host and start receive thread if necessary.
+
+        Called by ``NSMClient.init`` for clients created with this host, when
+        the client's OSC server has been created.
+
+        """
+        with self._lock:
+            self.clients.append(client)
+            self._servers[client.osc_server.fileno()] = client.osc_server
+
+        if self._thread is None:
+            self.start()
+        else:
+            self._wake()
+
+    def remove(self, client):
+        """Remove client from host and free its OSC server."""
+        with self._lock:
+            if client not in self.clients:
+                return
+
+            self.clients.remove(client)
+            server = self._servers.pop(client.osc_server.fileno(), None)
+
+            if server is not None:
+                self._closing.append(server)
+
+        if self._thread is None:
+            self._free_closing()
+        else:
+            self._wake()
+
+    def start(self):
+        """Start the receive thread."""
+        if self._thread is None:
+            self._wakeup = socket.socketpair()
+            self._thread = threading.Thread(target=self._run, daemon=True,
+                                            name="NSMClientHost")
+            self._thread.start()
+
+    def stop(self):
+        """Stop the receive thread and wait for it to finish."""
+        thread = self._thread
+
+        if thread is not None:
+            self._thread = None
+            self._wake(b"q")
+
+            if thread is not threading.current_thread():
+                thread.join()
+
+    def close(self):
+        """Close all hosted clients and stop the receive thread."""
+        for client in list(self.clients):
+            client.close()
+
+        self.stop()
+        self._free_closing()
+
+    def handle_sigterm(self, signal, frame):
+        """Handle system signal SIGTERM by closing all clients and exiting."""
+        self.close()
+        sys.exit()
+
+    def _wake(self, cmd=b"w"):
+        try:
+            self._wakeup[1].send(cmd)
+        except (OSError, TypeError):
+            pass
+
+    def _free_closing(self):
+        with self._lock:
+            closing, self._closing = self._closing, []
+
+        for server in closing:
+            server.free()
+
+    def _run(self):
+        wakeup = self._wakeup[0]
+
+        try:
+            while True:
+                self._free_closing()
+
+                with self._lock:
+                    servers = dict(self._servers)
+
+                ready = select.select([wakeup] + list(servers), [], [])[0]
+
+                if wakeup in ready:
+                    if b"q" in wakeup.recv(4096):
+                        break
+
+                for fd in ready:
+                    server = servers.get(fd)
+
+                    if server is not None and fd in self._servers:
+                        while server.recv(0):
+                            pass
+        finally:
+            for sock in self._wakeup:
+                sock.close()
+
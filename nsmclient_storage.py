@@ -0,0 +1,730 @@
+# -*- coding: utf-8 -*-
+"""Session storage helpers for NSM clients written with nsmclient.
+
+These helpers do not depend on the NSM protocol, but address common needs of
+clients with large sessions:
+
+``JournaledSessionStore``
+    Appends changes to a journal, so saving takes time proportional to the
+    changes since the last save.
+``AssetPool``
+    Content-addressed store for large files shared between sessions.
+``MappedFile``, ``MappedRecordFile``
+    Memory-mapped session files.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import hashlib
+import json
+import logging
+import mmap
+import os
+import pickle
+import shutil
+import struct
+import threading
+
+from collections import namedtuple
+from functools import partial
+from os.path import abspath, basename, dirname, join
+from zlib import crc32
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows
+    fcntl = None
+
+from nsmclient import ErrCode, NSMError, _write_file_atomic
+
+
+log = logging.getLogger(__name__)
+
+
+def _fsync_directory(path):
+    """Flush directory entries of the given directory to disk, if possible."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class JournaledSessionStore(object):
+    """Session store, which appends changes to a journal instead of rewriting
+    the whole session on every save.
+
+    The session state is kept in a snapshot file and a sequence of journal
+    files of change records in ``directory`` (by default the client's session
+    path). ``apply`` is a function, which is called with the session state and
+    a change record and returns the new state.
+
+    The application calls ``append`` for each change, which also marks the
+    client as dirty, and ``sync`` in ``save_session``, which writes the
+    journal to disk. When the journal grows beyond ``compact_threshold``
+    bytes, it is folded into a new snapshot by a background thread. The
+    background thread loads the last snapshot from disk and applies the
+    journal to it, so the application's state is not accessed, but memory
+    for a second copy of the state is needed temporarily.
+
+    ``load`` reads the snapshot and applies all journal records written after
+    it. Records are serialized with ``dumps`` and ``loads``, which default to
+    the functions of the ``pickle`` module. A record only partly written,
+    e.g. due to a crash, is ignored when loading.
+
+    Example::
+
+        def open_session(self, session_prefix, session_name, client_id):
+            self.store = JournaledSessionStore(self, apply_change,
+                                               directory=session_prefix)
+            self.project = self.store.load(initial=Project())
+            return session_prefix
+
+        def save_session(self, session_path):
+            self.store.sync()
+
+        def edit(self, change):
+            self.project = apply_change(self.project, change)
+            self.store.append(change)
+
+    """
+
+    SNAPSHOT = "snapshot"
+    JOURNAL = "journal.%i"
+    _SNAPSHOT_HEADER = struct.Struct('<8sQ')
+    _SNAPSHOT_MAGIC = b'NSMSNAP1'
+    # Record header: length, CRC-32 of the payload
+    _RECORD_HEADER = struct.Struct('<II')
+
+    def __init__(self, client, apply, directory=None,
+                 compact_threshold=16 * 1024 * 1024, dumps=None, loads=None):
+        if dumps is None or loads is None:
+            dumps = dumps or partial(pickle.dumps,
+                                     protocol=pickle.HIGHEST_PROTOCOL)
+            loads = loads or pickle.loads
+
+        self.client = client
+        self.apply = apply
+        self.directory = directory
+        self.compact_threshold = compact_threshold
+        self.dumps = dumps
+        self.loads = loads
+        self._lock = threading.Lock()
+        self._journal = None
+        self._generation = 0
+        self._initial = None
+        self._compactor = None
+
+    def load(self, initial=None):
+        """Return the session state read from the snapshot and journal.
+
+        ``initial`` is the state of a new session without a snapshot. After
+        loading, changes are appended to a new journal file, or to the last
+        one, if it is empty.
+
+        """
+        if self.directory is None:
+            self.directory = self.client.state.session_path
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._initial = self.dumps(initial)
+        state, snap_generation = self._read_snapshot()
+        generation = snap_generation
+
+        for gen in self._journal_generations():
+            if gen > snap_generation:
+                for record in self._read_journal(gen):
+                    state = self.apply(state, record)
+
+            generation = max(generation, gen)
+
+        if generation == snap_generation or os.path.getsize(
+                join(self.directory, self.JOURNAL % generation)):
+            generation += 1
+
+        with self._lock:
+            self._open_journal(generation)
+
+        return state
+
+    def append(self, record):
+        """Append a change record to the journal and mark client as dirty.
+
+        May be called from any thread. The record is written to disk by the
+        next call of ``sync``.
+
+        """
+        data = self.dumps(record)
+
+        with self._lock:
+            self._journal.write(self._RECORD_HEADER.pack(
+                len(data), crc32(data)))
+            self._journal.write(data)
+
+            if (self._journal.tell() >= self.compact_threshold and
+                    self._compactor is None):
+                self._compactor = threading.Thread(
+                    target=self._compact, args=(self._rotate(),),
+                    daemon=True, name="JournalCompaction")
+                self._compactor.start()
+
+        if self.client is not None:
+            self.client.set_dirty(True, internal=True)
+
+    def sync(self):
+        """Write all appended change records to disk."""
+        with self._lock:
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+
+    def compact(self):
+        """Fold the journal into a new snapshot in the calling thread."""
+        self.wait()
+
+        with self._lock:
+            generation = self._rotate()
+
+        self._compact(generation)
+
+    def wait(self):
+        """Wait for a running background compaction to finish."""
+        compactor = self._compactor
+
+        if compactor is not None:
+            compactor.join()
+
+    def close(self):
+        """Write the journal to disk and close it.
+
+        The journal file is removed, if no changes were appended to it.
+
+        """
+        self.wait()
+
+        with self._lock:
+            if self._journal is not None:
+                journal = self._journal
+                self._journal = None
+
+                if journal.tell() == 0:
+                    journal.close()
+                    os.unlink(journal.name)
+                    _fsync_directory(self.directory)
+                else:
+                    journal.flush()
+                    os.fsync(journal.fileno())
+                    journal.close()
+
+    def _open_journal(self, generation):
+        self._generation = generation
+        self._journal = open(join(self.directory, self.JOURNAL % generation),
+                             'ab')
+        _fsync_directory(self.directory)
+
+    def _rotate(self):
+        """Start a new journal file and return generation of the old one.
+
+        Must be called with the lock held.
+
+        """
+        generation = self._generation
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._journal.close()
+        self._open_journal(generation + 1)
+        return generation
+
+    def _compact(self, generation):
+        """Write snapshot including all journals up to given generation."""
+        try:
+            state, snap_generation = self._read_snapshot()
+            journals = [gen for gen in self._journal_generations()
+                        if gen <= generation]
+
+            for gen in journals:
+                if gen > snap_generation:
+                    for record in self._read_journal(gen):
+                        state = self.apply(state, record)
+
+            data = self.dumps(state)
+            header = self._SNAPSHOT_HEADER.pack(self._SNAPSHOT_MAGIC,
+                                                generation)
+
+            def write(fp):
+                fp.write(header)
+                fp.write(data)
+
+            _write_file_atomic(join(self.directory, self.SNAPSHOT), write)
+            _fsync_directory(self.directory)
+
+            for gen in journals:
+                os.unlink(join(self.directory, self.JOURNAL % gen))
+
+            log.debug("Compacted journal into snapshot (%i bytes).",
+                      len(data))
+        except Exception:
+            log.exception("Could not compact session journal.")
+        finally:
+            self._compactor = None
+
+    def _read_snapshot(self):
+        """Return state and journal generation stored in the snapshot."""
+        try:
+            with open(join(self.directory, self.SNAPSHOT), 'rb') as fp:
+                magic, generation = self._SNAPSHOT_HEADER.unpack(
+                    fp.read(self._SNAPSHOT_HEADER.size))
+
+                if magic != self._SNAPSHOT_MAGIC:
+                    raise NSMError("Invalid session snapshot file.",
+                                   ErrCode.BAD_PROJECT)
+
+                return self.loads(fp.read()), generation
+        except FileNotFoundError:
+            return self.loads(self._initial), 0
+
+    def _journal_generations(self):
+        """Return sorted generation numbers of existing journal files."""
+        prefix = self.JOURNAL.split('%')[0]
+        generations = []
+
+        for name in os.listdir(self.directory):
+            if name.startswith(prefix) and name[len(prefix):].isdigit():
+                generations.append(int(name[len(prefix):]))
+
+        return sorted(generations)
+
+    def _read_journal(self, generation):
+        """Iterate over the change records in a journal file."""
+        size = self._RECORD_HEADER.size
+
+        with open(join(self.directory, self.JOURNAL % generation),
+                  'rb') as fp:
+            while True:
+                header = fp.read(size)
+
+                if len(header) < size:
+                    break
+
+                length, crc = self._RECORD_HEADER.unpack(header)
+                data = fp.read(length)
+
+                if len(data) < length or crc32(data) != crc:
+                    log.warning("Ignoring incomplete record at end of "
+                                "journal %i.", generation)
+                    break
+
+                yield self.loads(data)
+
+
+# Linux ioctl to share the data blocks of a file with another file (reflink)
+FICLONE = 0x40049409
+
+
+class AssetPool(object):
+    """Content-addressed store for large files shared between sessions.
+
+    Files added to the pool are stored once per distinct content under
+    ``directory``, keyed by their hash digest, and can be materialized into
+    any number of session directories. Materializing uses, in this order of
+    preference, a reflink (copy-on-write clone, supported e.g. by Btrfs and
+    XFS), a hard link (if ``hardlinks`` is true and the session is on the same
+    file system as the pool) or a plain copy.
+
+    Pool files are read-only. Since hard-linked files share their content
+    with the pool, they must never be modified in place; replace them with a
+    new file instead.
+
+    File digests are cached in the pool directory by path, size and
+    modification time, so unchanged files are not hashed again. The cache is
+    written by ``flush``, which should be called after adding or
+    materializing a set of files, e.g. at the end of ``save_session``. It
+    also removes entries for files, which no longer exist or have changed.
+
+    """
+
+    def __init__(self, directory, hardlinks=True, algorithm='sha256'):
+        self.directory = directory
+        self.hardlinks = hardlinks
+        self.algorithm = algorithm
+        self._cache_path = join(directory, "hashes.json")
+        self._hashes = None
+        self._cache_changed = False
+        self._lock = threading.Lock()
+
+    def object_path(self, digest):
+        """Return path of the pool file with the given digest."""
+        return join(self.directory, "objects", digest[:2], digest[2:])
+
+    def hash_file(self, path):
+        """Return hex digest of the content of a file."""
+        path = abspath(path)
+        st = os.stat(path)
+        key = [st.st_size, st.st_mtime_ns]
+
+        with self._lock:
+            entry = self._load_cache().get(path)
+
+        if entry is not None and entry[:2] == key:
+            return entry[2]
+
+        digest = self._hash(path)
+        self._remember(path, key, digest)
+        return digest
+
+    def add(self, path):
+        """Store the content of a file in the pool and return its digest."""
+        digest = self.hash_file(path)
+        obj = self.object_path(digest)
+
+        if not os.path.exists(obj):
+            os.makedirs(dirname(obj), exist_ok=True)
+            # Not hard-linked, the file may still be changed in place.
+            tmp = self._temp_path(obj)
+
+            if not self._reflink(path, tmp):
+                shutil.copyfile(path, tmp)
+
+            os.chmod(tmp, 0o444)
+            os.replace(tmp, obj)
+
+        return digest
+
+    def materialize(self, digest, dest):
+        """Create or replace file dest with the pool file with given digest.
+
+        Returns how the file was created: ``'reflink'``, ``'hardlink'`` or
+        ``'copy'``, or ``'unchanged'`` if dest already had that content.
+
+        """
+        obj = self.object_path(digest)
+
+        if not os.path.exists(obj):
+            raise NSMError("Asset '%s' not found in pool." % digest,
+                           ErrCode.NO_SUCH_FILE)
+
+        try:
+            if self.hash_file(dest) == digest:
+                return 'unchanged'
+        except FileNotFoundError:
+            pass
+
+        directory = dirname(abspath(dest))
+        os.makedirs(directory, exist_ok=True)
+        tmp = self._temp_path(dest)
+
+        try:
+            if self._reflink(obj, tmp):
+                method = 'reflink'
+            else:
+                method = 'copy'
+
+                if self.hardlinks:
+                    try:
+                        os.link(obj, tmp)
+                        method = 'hardlink'
+                    except OSError:
+                        pass
+
+                if method == 'copy':
+                    shutil.copyfile(obj, tmp)
+
+            os.replace(tmp, dest)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+            raise
+
+        st = os.stat(dest)
+        self._remember(abspath(dest), [st.st_size, st.st_mtime_ns], digest)
+        return method
+
+    def flush(self):
+        """Write the digest cache to disk, if it has changed.
+
+        Entries of files, which no longer exist or whose size or modification
+        time have changed, are removed from the cache first.
+
+        """
+        with self._lock:
+            if not self._cache_changed:
+                return
+
+            entries = list(self._hashes.items())
+
+        stale = []
+
+        for path, entry in entries:
+            try:
+                st = os.stat(path)
+            except OSError:
+                stale.append((path, entry))
+                continue
+
+            if entry[:2] != [st.st_size, st.st_mtime_ns]:
+                stale.append((path, entry))
+
+        with self._lock:
+            for path, entry in stale:
+                # Unless updated by another thread in the meantime
+                if self._hashes.get(path) is entry:
+                    del self._hashes[path]
+
+            data = json.dumps(self._hashes)
+            self._cache_changed = False
+
+        os.makedirs(self.directory, exist_ok=True)
+        _write_file_atomic(self._cache_path, data, fsync=False)
+
+    def _load_cache(self):
+        """Return the digest cache, reading it from disk on first use.
+
+        Must be called with the lock held.
+
+        """
+        if self._hashes is None:
+            try:
+                with open(self._cache_path) as fp:
+                    self._hashes = json.load(fp)
+            except (OSError, ValueError):
+                self._hashes = {}
+
+        return self._hashes
+
+    def _remember(self, path, key, digest):
+        with self._lock:
+            self._load_cache()[path] = key + [digest]
+            self._cache_changed = True
+
+    def _hash(self, path):
+        with open(path, 'rb') as fp:
+            if hasattr(hashlib, 'file_digest'):
+                return hashlib.file_digest(fp, self.algorithm).hexdigest()
+
+            hasher = hashlib.new(self.algorithm)
+
+            for chunk in iter(partial(fp.read, 1 << 20), b''):
+                hasher.update(chunk)
+
+            return hasher.hexdigest()
+
+    @staticmethod
+    def _temp_path(path):
+        return join(dirname(abspath(path)), ".%s.%i.%i.tmp" % (
+            basename(path), os.getpid(), threading.get_ident()))
+
+    @staticmethod
+    def _reflink(src, dst):
+        """Try to create dst as a reflink of src. Returns ``True`` on success.
+        """
+        if fcntl is None:
+            return False
+
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return True
+        except OSError:
+            try:
+                os.unlink(dst)
+            except OSError:
+                pass
+
+            return False
+
+
+class MappedFile(object):
+    """Read-only memory map of a (session) file.
+
+    The file content is accessible without copying through the memoryview
+    ``view``. Pages are only read from disk when they are accessed, so
+    opening even very large files is fast and only the parts actually used
+    count towards the memory use of the process.
+
+    ``close`` fails with ``BufferError`` as long as memoryviews derived from
+    ``view`` (e.g. by ``cast`` or slicing) are still in use. Release them
+    first.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, 'rb') as fp:
+            size = os.fstat(fp.fileno()).st_size
+            # Empty files can not be mapped
+            self._mmap = (mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+                          if size else None)
+
+        self.view = memoryview(self._mmap if size else b'')
+
+    def __len__(self):
+        return len(self.view)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def cast(self, format, offset=0, count=None):
+        """Return a memoryview of the data at offset as items of format.
+
+        ``format`` is a single ``struct`` format character, e.g. ``'f'`` for
+        32-bit floats. ``count`` defaults to as many items as fit.
+
+        """
+        size = struct.calcsize(format)
+
+        if count is None:
+            count = (len(self.view) - offset) // size
+
+        return self.view[offset:offset + count * size].cast(format)
+
+    def unpack(self, format, offset=0):
+        """Unpack values of the struct format (or ``struct.Struct``) at offset.
+        """
+        if isinstance(format, struct.Struct):
+            return format.unpack_from(self.view, offset)
+
+        return struct.unpack_from(format, self.view, offset)
+
+    def close(self):
+        """Release the view and unmap the file."""
+        self.view.release()
+
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+
+class MappedRecordFile(object):
+    """Memory-mapped file of fixed-size binary records for in-place updates.
+
+    Each record has the layout of the ``struct`` format ``format``. If
+    ``fields`` is given, records are returned as named tuples with these field
+    names. The file is created if needed and resized to ``count`` records, if
+    ``count`` is given, otherwise its size must be a multiple of the record
+    size.
+
+    Records are updated in place by assigning to an index. Changes are
+    written to disk by the operating system at some point, call ``flush``,
+    e.g. in ``save_session``, to write them immediately (``msync``).
+
+    Example::
+
+        voices = MappedRecordFile(join(session_path, "voices.bin"), '<ifff',
+                                  count=128,
+                                  fields=('note', 'gain', 'pan', 'tune'))
+        voices[3] = (60, 0.8, 0.0, 0.0)
+        voices.flush()
+
+    """
+
+    def __init__(self, path, format, count=None, fields=None):
+        self.path = path
+        self.struct = struct.Struct(format)
+        self.record = namedtuple('Record', fields) if fields else None
+        self._fp = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        self._mmap = None
+
+        try:
+            size = os.fstat(self._fp.fileno()).st_size
+
+            if count is None:
+                if size % self.struct.size:
+                    raise ValueError("Size of '%s' is not a multiple of the "
+                                     "record size." % path)
+
+                count = size // self.struct.size
+
+            self._map(count)
+        except BaseException:
+            self._fp.close()
+            raise
+
+    def _map(self, count):
+        size = count * self.struct.size
+
+        if os.fstat(self._fp.fileno()).st_size != size:
+            self._fp.truncate(size)
+
+        self.count = count
+        self._mmap = mmap.mmap(self._fp.fileno(), size) if size else None
+        self.view = memoryview(self._mmap if size else bytearray())
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __getitem__(self, index):
+        if not -self.count <= index < self.count:
+            raise IndexError("Record index out of range.")
+
+        values = self.struct.unpack_from(self.view,
+                                         (index % self.count) *
+                                         self.struct.size)
+        return self.record._make(values) if self.record else values
+
+    def __setitem__(self, index, values):
+        if not -self.count <= index < self.count:
+            raise IndexError("Record index out of range.")
+
+        self.struct.pack_into(self.view,
+                              (index % self.count) * self.struct.size,
+                              *values)
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield self[index]
+
+    def resize(self, count):
+        """Change the number of records in the file."""
+        self._unmap()
+        self._map(count)
+
+    def flush(self):
+        """Write changed records to disk."""
+        if self._mmap is not None:
+            self._mmap.flush()
+
+    def close(self):
+        """Write changes to disk, unmap and close the file."""
+        if self._fp is not None:
+            self.flush()
+            self._unmap()
+            self._fp.close()
+            self._fp = None
+
+    def _unmap(self):
+        self.view.release()
+
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
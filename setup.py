@@ -8,7 +8,7 @@ from distutils.core import setup
 setup(
     name="nsmclient",
     version="0.2b",
-    py_modules=["nsmclient"],
+    py_modules=["nsmclient", "nsmclient_storage"],
     author="Nils Gey",
     author_email="ich@nilsgey.de",
     maintainer="Christopher Arndt",
@@ -16,5 +16,5 @@ setup(
     url="https://github.com/SpotlightKid/pynsmclient",
     description=__doc__,
     license="GPLv3+",
-    install_requires=["pyliblo"]
+    extras_require={"liblo": ["pyliblo"]}
 )
@@ -0,0 +1,99 @@
+"""Tests for AsyncNSMClient against a stand-in NSM server."""
+
+import asyncio
+import os
+import unittest
+
+from unittest import mock
+
+from benchmark import StandInNSMServer
+from nsmclient import (BACKEND_UDP, CAP_DIRTY, MSG_OPEN, MSG_SAVE,
+                       AsyncNSMClient, encode_osc_message)
+
+
+class Client(AsyncNSMClient):
+    capabilities = (CAP_DIRTY,)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.release = asyncio.Event()
+        self.release.set()
+        self.started = asyncio.Event()
+        self.events = []
+
+    async def open_session(self, session_prefix, session_name, client_id,
+                           cancel=None):
+        self.started.set()
+        await self.release.wait()
+        cancel.check()
+        self.events.append(("open", session_prefix))
+        return "/data"
+
+    def save_session(self, session_path):
+        self.events.append(("save", session_path))
+
+
+class TestAsyncNSMClient(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.server = StandInNSMServer()
+        self.addCleanup(self.server.close)
+        self.client = Client(backend=BACKEND_UDP)
+
+        with mock.patch.dict(os.environ, NSM_URL=self.server.url):
+            self.assertIsNotNone(await self.client.init())
+
+    async def asyncTearDown(self):
+        client = self.client
+        asyncio.get_running_loop().remove_reader(client.osc_server.fileno())
+        client.osc_server.free()
+
+    async def request(self, path, *args):
+        await asyncio.get_running_loop().run_in_executor(
+            None, self.server.request, path, *args)
+
+    def send(self, path, *args):
+        """Send a request without waiting for the reply."""
+        self.server.socket.sendto(encode_osc_message(path, *args),
+                                  self.server.client_addr)
+
+    async def wait_tasks(self, count):
+        """Wait until count operations have been scheduled."""
+        async def wait():
+            while len(self.client._tasks) < count:
+                await asyncio.sleep(0.005)
+
+        await asyncio.wait_for(wait(), 5)
+
+    async def test_open_save(self):
+        await self.request(MSG_OPEN, "/tmp/a", "session", "nA")
+        self.assertEqual(self.client.state.session_path, "/tmp/a/data")
+        await self.request(MSG_SAVE)
+        self.assertEqual(self.client.events,
+                         [("open", "/tmp/a"), ("save", "/tmp/a/data")])
+
+    async def test_open_superseded(self):
+        client = self.client
+        client.release.clear()
+        self.send(MSG_OPEN, "/tmp/a", "session", "nA")
+        await asyncio.wait_for(client.started.wait(), 5)
+        # Cancel the running open and supersede the waiting one
+        self.send(MSG_OPEN, "/tmp/b", "session", "nA")
+        self.send(MSG_OPEN, "/tmp/c", "session", "nA")
+        await self.wait_tasks(3)
+
+        client.release.set()
+        await asyncio.gather(*client._tasks)
+        self.assertEqual(client.events, [("open", "/tmp/c")])
+        self.assertEqual(client.state.session_path, "/tmp/c/data")
+
+    async def test_operations_in_order(self):
+        client = self.client
+        client.release.clear()
+        self.send(MSG_OPEN, "/tmp/a", "session", "nA")
+        self.send(MSG_SAVE)
+        await self.wait_tasks(2)
+
+        client.release.set()
+        await asyncio.gather(*client._tasks)
+        self.assertEqual(client.events,
+                         [("open", "/tmp/a"), ("save", "/tmp/a/data")])
@@ -0,0 +1,706 @@
+"""Tests for NSMClient helpers, which do not need an NSM server."""
+
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import nsmclient
+from nsmclient import (CAP_DIRTY, CAP_PROGRESS, CAP_SWITCH, MSG_CLEAN,
+                       MSG_DIRTY, MSG_ERROR, MSG_OPEN, MSG_PROGRESS,
+                       MSG_REPLY, MSG_SAVE, CancellationToken, DeferredOpen,
+                       ErrCode, NSMClient, NSMError, ProgressReporter,
+                       RealtimeSendQueue, SessionCache, TRACE_IN, TRACE_OUT,
+                       TraceReplayer, read_trace)
+
+
+class FakeServer(object):
+    """Stands in for the OSC server of a client and records sent messages."""
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, url, *args):
+        self.sent.append(args)
+
+    def send_bundle(self, url, messages):
+        self.sent.extend(messages)
+
+
+class Client(NSMClient):
+    capabilities = (CAP_DIRTY, CAP_PROGRESS)
+
+    def open_session(self, session_prefix, session_name, client_id):
+        return "/data"
+
+    def save_session(self, session_path):
+        pass
+
+
+def make_client(cls=Client, **kwargs):
+    client = cls(init=False, backend=nsmclient.BACKEND_UDP, **kwargs)
+    client.state = nsmclient.ClientState("osc.udp://127.0.0.1:1/")
+    client.osc_server = FakeServer()
+    client._freeze_capabilities()
+    return client
+
+
+class TestProgressReporter(unittest.TestCase):
+    def setUp(self):
+        self.client = make_client()
+        self.sent = self.client.osc_server.sent
+
+    def progress(self):
+        return [msg[1] for msg in self.sent if msg[0] == MSG_PROGRESS]
+
+    def test_iterable_with_length(self):
+        items = list(ProgressReporter(self.client, iterable=range(4),
+                                      interval=0, min_delta=0))
+        self.assertEqual(items, [0, 1, 2, 3])
+        self.assertEqual(self.progress(), [0.25, 0.5, 0.75, 1.0])
+
+    def test_generator(self):
+        reporter = ProgressReporter(self.client,
+                                    iterable=(i for i in range(4)),
+                                    interval=0, min_delta=0)
+        self.assertEqual(list(reporter), [0, 1, 2, 3])
+        self.assertEqual(self.progress(), [1.0])
+
+    def test_subtasks(self):
+        with self.client.progress(interval=0, min_delta=0) as progress:
+            with progress.subtask(0.5, total=2) as sub:
+                sub.advance()
+                sub.advance()
+
+            progress.subtask(0.5).update(0.5)
+
+        self.assertEqual(self.progress(), [0.25, 0.5, 0.75, 1.0])
+
+    def test_advance_without_total(self):
+        with self.assertRaises(ValueError):
+            ProgressReporter(self.client).advance()
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.client = make_client()
+        self.sent = self.client.osc_server.sent
+
+    def test_coalesce(self):
+        with self.client.batch():
+            self.client.update_progress(0.5)
+            self.client.set_dirty(True)
+            self.client.update_progress(1.0)
+            self.client.set_dirty(False)
+
+        self.assertEqual(self.sent, [(MSG_PROGRESS, 1.0), (MSG_CLEAN,)])
+        self.assertEqual(self.client.metrics()['sent'],
+                         {MSG_CLEAN: 1, MSG_PROGRESS: 1})
+
+    def test_dirty_state_changed_by_other_thread(self):
+        with self.client.batch():
+            self.client.set_dirty(True)
+            thread = threading.Thread(target=self.client.set_dirty,
+                                      args=(False,))
+            thread.start()
+            thread.join()
+
+        self.assertFalse(self.client.state.dirty)
+        self.assertEqual(self.sent[-1], (MSG_CLEAN,))
+
+
+class TestRealtimeSendQueue(unittest.TestCase):
+    def test_latest_values(self):
+        client = make_client()
+        queue = RealtimeSendQueue(client)
+
+        for i in range(1000):
+            queue.update_progress(i / 1000)
+            queue.set_dirty(i % 2 == 0)
+
+        queue.update_progress(1.0)
+        queue.flush()
+        self.assertEqual(client.osc_server.sent, [(MSG_PROGRESS, 1.0)])
+        queue.set_dirty(True)
+        queue.flush()
+        queue.flush()
+        self.assertEqual(client.osc_server.sent[1:], [(MSG_DIRTY,)])
+
+
+def failing_job(exc):
+    def write(fp):
+        raise exc
+
+    return write
+
+
+class SaveFilesClient(Client):
+    def save_session(self, session_path):
+        self.save_files({"a.txt": failing_job(FileNotFoundError())},
+                        fsync=False)
+
+
+class TestSaveFiles(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.client = make_client()
+        self.client.state.session_path = self.tmpdir
+
+    def read(self, name):
+        with open(os.path.join(self.tmpdir, name), 'rb') as fp:
+            return fp.read()
+
+    def test_save_files(self):
+        paths = self.client.save_files({
+            "a.txt": "text",
+            "sub/b.bin": b"data",
+            "c.bin": lambda fp: fp.write(b"written"),
+        }, fsync=False)
+        self.assertEqual(paths, [os.path.join(self.tmpdir, name)
+                                 for name in ("a.txt", "sub/b.bin", "c.bin")])
+        self.assertEqual(self.read("a.txt"), b"text")
+        self.assertEqual(self.read("sub/b.bin"), b"data")
+        self.assertEqual(self.read("c.bin"), b"written")
+        self.assertEqual(self.client.osc_server.sent[-1], (MSG_PROGRESS, 1.0))
+
+    def assertSaveError(self, exc, code):
+        with open(os.path.join(self.tmpdir, "b.txt"), 'w') as fp:
+            fp.write("old")
+
+        with self.assertLogs(nsmclient.log, "ERROR"):
+            with self.assertRaises(NSMError) as cm:
+                self.client.save_files([("a.txt", "a"),
+                                        ("b.txt", failing_job(exc))],
+                                       fsync=False)
+
+        self.assertEqual(cm.exception.code, code)
+        self.assertIn("1 of 2 files", str(cm.exception))
+        # The failed file is unchanged and no temporary file is left
+        self.assertEqual(self.read("b.txt"), b"old")
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ["a.txt", "b.txt"])
+
+    def test_general_error(self):
+        self.assertSaveError(ValueError("Bad data"), ErrCode.GENERAL)
+
+    def test_file_not_found(self):
+        self.assertSaveError(FileNotFoundError("Sample missing"),
+                             ErrCode.NO_SUCH_FILE)
+
+    def test_nsm_error(self):
+        self.assertSaveError(NSMError("Cannot save", ErrCode.BAD_PROJECT),
+                             ErrCode.BAD_PROJECT)
+
+    def test_error_reply(self):
+        client = make_client(SaveFilesClient, quit_on_error=False)
+        client.state.session_path = self.tmpdir
+
+        with self.assertLogs(nsmclient.log, "ERROR"):
+            client._dispatch(MSG_SAVE, [], "", None)
+
+        self.assertEqual(answers(client, MSG_SAVE),
+                         [ErrCode.NO_SUCH_FILE.value])
+
+
+class TestSessionCache(unittest.TestCase):
+    def test_pop_removes_entry(self):
+        with tempfile.TemporaryDirectory() as path:
+            cache = SessionCache()
+            cache.put(('prefix', 'nA'), ['state'], path)
+            self.assertIsNotNone(cache.get(('prefix', 'nA')))
+            self.assertEqual(cache.pop(('prefix', 'nA')).state, ['state'])
+            self.assertIsNone(cache.get(('prefix', 'nA')))
+            self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+
+class SwitchClient(Client):
+    capabilities = (CAP_SWITCH,)
+
+    def get_session_state(self):
+        raise RuntimeError("Cannot get state")
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out.")
+
+        time.sleep(0.005)
+
+
+class TestSessionSwitch(unittest.TestCase):
+    def open(self, client, prefix):
+        client._dispatch(MSG_OPEN, [prefix, "session", "nA"], "sss", None)
+
+    def replies(self, client):
+        return [msg for msg in client.osc_server.sent
+                if msg[:2] == (MSG_REPLY, MSG_OPEN)]
+
+    def test_failing_get_session_state(self):
+        client = make_client(SwitchClient, session_cache=SessionCache())
+        self.open(client, "/tmp/a")
+        self.open(client, "/tmp/b")
+        self.assertEqual(len(self.replies(client)), 2)
+
+    def test_failing_get_session_state_executor(self):
+        with ThreadPoolExecutor(1) as executor:
+            client = make_client(SwitchClient, session_cache=SessionCache(),
+                                 executor=executor)
+
+            for prefix in ("/tmp/a", "/tmp/b", "/tmp/c"):
+                self.open(client, prefix)
+                wait_for(lambda: len(self.replies(client)) == 1)
+                client.osc_server.sent.clear()
+
+    def test_max_bytes_requires_size(self):
+        with self.assertRaises(TypeError):
+            make_client(SwitchClient,
+                        session_cache=SessionCache(max_bytes=2 ** 20))
+
+
+class BlockingClient(Client):
+    """Client whose operations wait until ``release`` is set."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.started = threading.Semaphore(0)
+        self.release = threading.Event()
+        self.opened = []
+
+    def open_session(self, session_prefix, session_name, client_id,
+                     cancel=None):
+        self.started.release()
+        self.release.wait(5)
+        cancel.check()
+        self.opened.append(session_prefix)
+        return "/data"
+
+    def save_session(self, session_path):
+        self.started.release()
+        self.release.wait(5)
+
+
+class CancelCheckClient(Client):
+    def open_session(self, session_prefix, session_name, client_id,
+                     cancel=None):
+        cancel.check()
+        return "/data"
+
+
+def answers(client, path):
+    """Return the replies and error codes sent for requests to path."""
+    return [msg[0] if msg[0] == MSG_REPLY else msg[2]
+            for msg in client.osc_server.sent
+            if msg[0] in (MSG_REPLY, MSG_ERROR) and msg[1] == path]
+
+
+class TestExecutor(unittest.TestCase):
+    def setUp(self):
+        self.executor = ThreadPoolExecutor(1)
+        self.addCleanup(self.executor.shutdown)
+        self.client = make_client(BlockingClient, quit_on_error=False,
+                                  executor=self.executor)
+        self.addCleanup(self.client.release.set)
+
+    def request(self, path, *args):
+        self.client._dispatch(path, list(args), "s" * len(args), None)
+
+    def open(self, prefix):
+        self.request(MSG_OPEN, prefix, "session", "nA")
+
+    def test_open_superseded(self):
+        client = self.client
+        self.open("/tmp/a")
+        self.assertTrue(client.started.acquire(timeout=5))
+        self.open("/tmp/b")
+        self.open("/tmp/c")
+        pending = ErrCode.OPERATION_PENDING.value
+        self.assertEqual(answers(client, MSG_OPEN), [pending])
+
+        client.release.set()
+        wait_for(lambda: len(answers(client, MSG_OPEN)) == 3)
+        self.assertEqual(answers(client, MSG_OPEN),
+                         [pending, pending, MSG_REPLY])
+        self.assertEqual(client.opened, ["/tmp/c"])
+        self.assertEqual(client.state.session_path, "/tmp/c/data")
+
+    def test_saves_coalesced(self):
+        client = self.client
+        client.state.session_path = "/tmp/a"
+
+        for _ in range(3):
+            self.request(MSG_SAVE)
+
+        self.assertTrue(client.started.acquire(timeout=5))
+        client.release.set()
+        wait_for(lambda: len(answers(client, MSG_SAVE)) == 3)
+        self.assertEqual(answers(client, MSG_SAVE), [MSG_REPLY] * 3)
+        self.assertEqual(client.save_stats["saved"], 2)
+        self.assertEqual(client.save_stats["coalesced"], 1)
+
+    def test_save_while_opening(self):
+        client = self.client
+        self.open("/tmp/a")
+        self.assertTrue(client.started.acquire(timeout=5))
+        self.request(MSG_SAVE)
+        self.assertEqual(answers(client, MSG_SAVE),
+                         [ErrCode.OPERATION_PENDING.value])
+
+        client.release.set()
+        wait_for(lambda: answers(client, MSG_OPEN) == [MSG_REPLY])
+        self.request(MSG_SAVE)
+        wait_for(lambda: len(answers(client, MSG_SAVE)) == 2)
+        self.assertEqual(answers(client, MSG_SAVE)[1], MSG_REPLY)
+
+
+class FingerprintClient(BlockingClient):
+    capabilities = ()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, skip_unchanged_saves=True, **kwargs)
+        self.data = 1
+
+    def session_fingerprint(self):
+        return self.data
+
+
+class TestSkipUnchangedSaves(unittest.TestCase):
+    def make_client(self, cls=FingerprintClient, **kwargs):
+        client = make_client(cls, quit_on_error=False, **kwargs)
+        self.addCleanup(client.release.set)
+        return client
+
+    def open(self, client):
+        client._dispatch(MSG_OPEN, ["/tmp/a", "session", "nA"], "sss", None)
+
+    def save(self, client):
+        client._dispatch(MSG_SAVE, [], "", None)
+
+    def test_unchanged_fingerprint(self):
+        client = self.make_client()
+        client.release.set()
+        self.open(client)
+        self.save(client)
+        self.save(client)
+        client.data = 2
+        self.save(client)
+        self.assertEqual(answers(client, MSG_SAVE), [MSG_REPLY] * 3)
+        self.assertEqual(client.save_stats["saved"], 2)
+        self.assertEqual(client.save_stats["skipped_unchanged"], 1)
+
+    def test_clean(self):
+        class DirtyClient(BlockingClient):
+            pass
+
+        client = self.make_client(DirtyClient, skip_unchanged_saves=True)
+        client.release.set()
+        self.open(client)
+        self.save(client)
+        self.save(client)
+        client.set_dirty(True)
+        self.save(client)
+        self.assertEqual(client.save_stats["saved"], 2)
+        self.assertEqual(client.save_stats["skipped_clean"], 1)
+
+    def test_coalesced_saves(self):
+        with ThreadPoolExecutor(1) as executor:
+            client = self.make_client(executor=executor)
+            client.release.set()
+            self.open(client)
+            wait_for(lambda: answers(client, MSG_OPEN))
+            client.release.clear()
+            self.save(client)
+            self.assertTrue(client.started.acquire(timeout=5))
+            # Coalesced into one save, which starts after the running one
+            client.data = 2
+            self.save(client)
+            self.save(client)
+            client.release.set()
+            wait_for(lambda: len(answers(client, MSG_SAVE)) == 3)
+            self.assertEqual(client._saved_fingerprint, 2)
+            self.save(client)
+
+        self.assertEqual(answers(client, MSG_SAVE), [MSG_REPLY] * 4)
+        self.assertEqual(client.save_stats["saved"], 2)
+        self.assertEqual(client.save_stats["skipped_unchanged"], 1)
+
+    def test_failing_fingerprint(self):
+        class FailingClient(FingerprintClient):
+            def session_fingerprint(self):
+                raise RuntimeError("No fingerprint")
+
+        client = self.make_client(FailingClient)
+        client.release.set()
+        self.open(client)
+
+        with self.assertLogs(nsmclient.log, "ERROR"):
+            self.save(client)
+
+        self.assertEqual(answers(client, MSG_SAVE), [MSG_REPLY])
+
+
+class DeferredClient(Client):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.release = threading.Event()
+        self.load_error = None
+        self.events = []
+
+    def open_session(self, session_prefix, session_name, client_id):
+        self.events.append("open")
+        return DeferredOpen("/data", self.load)
+
+    def load(self, progress):
+        self.release.wait(5)
+        progress.update(1.0)
+
+        if self.load_error is not None:
+            raise self.load_error
+
+        self.events.append("loaded")
+
+    def save_session(self, session_path):
+        self.events.append("save")
+
+
+class TestDeferredOpen(unittest.TestCase):
+    def setUp(self):
+        self.client = make_client(DeferredClient, quit_on_error=False)
+        self.addCleanup(self.client.release.set)
+        self.client._dispatch(MSG_OPEN, ["/tmp/a", "session", "nA"], "sss",
+                              None)
+
+    def test_reply_before_load(self):
+        client = self.client
+        self.assertEqual(answers(client, MSG_OPEN), [MSG_REPLY])
+        self.assertEqual(client.state.session_path, "/tmp/a/data")
+        client.release.set()
+        wait_for(lambda: "loaded" in client.events)
+
+    def test_held_save(self):
+        client = self.client
+        client._dispatch(MSG_SAVE, [], "", None)
+        client._dispatch(MSG_SAVE, [], "", None)
+        self.assertEqual(answers(client, MSG_SAVE), [])
+
+        client.release.set()
+        wait_for(lambda: len(answers(client, MSG_SAVE)) == 2)
+        self.assertEqual(answers(client, MSG_SAVE), [MSG_REPLY] * 2)
+        self.assertEqual(client.events, ["open", "loaded", "save", "save"])
+
+    def test_held_saves_executor(self):
+        saving = threading.Event()
+
+        class SlowSaveClient(DeferredClient):
+            def save_session(self, session_path):
+                saving.wait(5)
+
+        with ThreadPoolExecutor(1) as executor:
+            client = make_client(SlowSaveClient, executor=executor)
+            client.release.set()
+            client._loading = DeferredOpen("/data", client.load)
+
+            for _ in range(3):
+                client._dispatch(MSG_SAVE, [], "", None)
+
+            client._run_deferred_load(client._loading)
+            saving.set()
+            wait_for(lambda: len(answers(client, MSG_SAVE)) == 3)
+
+        self.assertEqual(client.save_stats["saved"], 2)
+        self.assertEqual(client.save_stats["coalesced"], 1)
+
+    def test_open_while_loading(self):
+        client = self.client
+        client._dispatch(MSG_OPEN, ["/tmp/b", "session", "nA"], "sss", None)
+        self.assertEqual(answers(client, MSG_OPEN),
+                         [MSG_REPLY, ErrCode.OPERATION_PENDING.value])
+        self.assertEqual(client.state.session_path, "/tmp/a/data")
+
+    def test_load_failed(self):
+        client = self.client
+        client.load_error = RuntimeError("Cannot load")
+        client._dispatch(MSG_SAVE, [], "", None)
+
+        client._dispatch(MSG_SAVE, [], "", None)
+
+        with self.assertLogs(nsmclient.log, "ERROR"):
+            client.release.set()
+            wait_for(lambda: len(answers(client, MSG_SAVE)) == 2)
+
+        # A partially loaded session must not overwrite the saved one
+        self.assertEqual(answers(client, MSG_SAVE),
+                         [ErrCode.GENERAL.value] * 2)
+        self.assertNotIn("save", client.events)
+
+
+class TestCancellation(unittest.TestCase):
+    def test_token(self):
+        token = CancellationToken()
+        token.check()
+        token.cancel()
+        self.assertTrue(token.cancelled)
+        self.assertRaises(nsmclient.OperationCancelled, token.check)
+
+    def test_pickled_token(self):
+        token = CancellationToken()
+        token.cancel()
+        copy = pickle.loads(pickle.dumps(token))
+        self.assertFalse(copy.cancelled)
+        copy.check()
+
+    def test_token_without_executor(self):
+        client = make_client(CancelCheckClient)
+        client._dispatch(MSG_OPEN, ["/tmp/a", "session", "nA"], "sss", None)
+        self.assertEqual(answers(client, MSG_OPEN), [MSG_REPLY])
+
+    def test_token_process_pool(self):
+        with ProcessPoolExecutor(1) as executor:
+            client = make_client(CancelCheckClient, quit_on_error=False,
+                                 executor=executor)
+            client._dispatch(MSG_OPEN, ["/tmp/a", "session", "nA"], "sss",
+                             None)
+            wait_for(lambda: answers(client, MSG_OPEN))
+
+        self.assertEqual(answers(client, MSG_OPEN), [MSG_REPLY])
+
+
+class TestTrace(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "session.trace")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_client(self):
+        client = make_client()
+        client.calls = []
+
+        @client.add_handler("/foo/bar")
+        def handle_bar(path, args, types):
+            client.calls.append((args, types))
+            client.set_dirty(True)
+
+        return client
+
+    def test_record(self):
+        client = self.make_client()
+        client.start_recording(self.path)
+        client._dispatch("/foo/bar", [0.5, 0.25, 7], "fdh", None)
+        client.stop_recording()
+        records = list(read_trace(self.path))
+        self.assertEqual(
+            [(rec.direction, rec.path, rec.args, rec.types)
+             for rec in records],
+            [(TRACE_IN, "/foo/bar", [0.5, 0.25, 7], "fdh"),
+             (TRACE_OUT, MSG_DIRTY, [], "")])
+        self.assertGreaterEqual(records[0].duration, 0.0)
+
+    def test_replay(self):
+        client = self.make_client()
+        client.start_recording(self.path)
+        client._dispatch("/foo/bar", [0.5, 0.25, 7], "fdh", None)
+        client._dispatch("/foo/bar", [1.0, 2.0, 2 ** 40], "fdh", None)
+        client.stop_recording()
+
+        replay_client = self.make_client()
+        timings = TraceReplayer(self.path).run(replay_client, realtime=False)
+        self.assertEqual(replay_client.calls, client.calls)
+        self.assertEqual([timing.path for timing in timings],
+                         ["/foo/bar", "/foo/bar"])
+        self.assertEqual(TraceReplayer.summary(timings)["/foo/bar"]["count"],
+                         2)
+
+
+class TestProfiling(unittest.TestCase):
+    def test_profile_registered_handlers_only(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        client = make_client()
+        client.add_handler("/foo/bar", lambda path, args: None)
+        client.enable_profiling(tmpdir)
+        client._dispatch("/foo/bar", [], "", None)
+        client._dispatch("/foo/unknown", [], "", None)
+        client.disable_profiling()
+        files = os.listdir(tmpdir)
+        self.assertTrue(files)
+        self.assertTrue(all("bar" in name for name in files), files)
+
+
+class TestRateLimiter(unittest.TestCase):
+    def make_limiter(self, **kwargs):
+        reported = []
+        limiter = nsmclient._RateLimiter(
+            on_suppressed=lambda key, count: reported.append((key, count)),
+            **kwargs)
+        return limiter, reported
+
+    def test_limit(self):
+        limiter, reported = self.make_limiter(limit=2, interval=60)
+        self.assertEqual([limiter.check("/a") for _ in range(4)],
+                         [(True, "/a"), (True, "/a"), (False, "/a"),
+                          (False, "/a")])
+        self.assertEqual(limiter.check("/b"), (True, "/b"))
+        self.assertEqual(reported, [])
+
+    def test_shared_window(self):
+        limiter, reported = self.make_limiter(limit=1, interval=60,
+                                              max_keys=1)
+        self.assertEqual(limiter.check("/a"), (True, "/a"))
+        self.assertEqual(limiter.check("/b"), (True, None))
+        self.assertEqual(limiter.check("/c"), (False, None))
+
+    def test_summary_without_further_events(self):
+        limiter, reported = self.make_limiter(limit=1, interval=0.05)
+        limiter.check("/a")
+        limiter.check("/a")
+        limiter.check("/a")
+        limiter.check("/b")
+        wait_for(lambda: reported)
+        self.assertEqual(reported, [("/a", 2)])
+        # A new window begins after the summary
+        self.assertEqual(limiter.check("/a"), (True, "/a"))
+
+    def test_unknown_messages(self):
+        client = make_client()
+        client.unknown_log_limit = 1
+        client.unknown_log_interval = 0.05
+        client._init_unknown_limiter()
+
+        with self.assertLogs(nsmclient.log, "WARNING") as logs:
+            for _ in range(3):
+                client._dispatch("/foo", [], "", None)
+
+            wait_for(lambda: len(logs.output) == 2)
+
+        self.assertIn("2 unknown OSC messages to '/foo' suppressed",
+                      logs.output[1])
+        self.assertEqual(client.metrics()["unknown_suppressed"], 2)
+
+
+class TestPickle(unittest.TestCase):
+    def test_copy_can_send_updates(self):
+        client = make_client()
+        client.session_cache = SessionCache()
+        copy = pickle.loads(pickle.dumps(client))
+        self.assertIsNone(copy.osc_server)
+        self.assertIsNone(copy.session_cache)
+
+        with copy.progress(total=2) as progress:
+            progress.advance()
+            copy.set_dirty(True)
+
+        self.assertTrue(copy.state.dirty)
+        self.assertEqual(client.osc_server.sent, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+"""Tests for running several clients in one process with NSMClientHost."""
+
+import os
+import unittest
+
+from unittest import mock
+
+from benchmark import StandInNSMServer
+from nsmclient import (BACKEND_UDP, CAP_DIRTY, MSG_OPEN, MSG_SAVE, NSMClient,
+                       NSMClientHost)
+
+
+class Client(NSMClient):
+    capabilities = (CAP_DIRTY,)
+
+    def __init__(self, *args, **kwargs):
+        self.saved = []
+        self.quit_called = False
+        super().__init__(*args, **kwargs)
+
+    def open_session(self, session_prefix, session_name, client_id):
+        return "/data"
+
+    def save_session(self, session_path):
+        self.saved.append(session_path)
+
+    def quit(self):
+        self.quit_called = True
+
+
+class TestNSMClientHost(unittest.TestCase):
+    def setUp(self):
+        self.host = NSMClientHost(install_sigterm=False)
+        self.addCleanup(self.host.close)
+        self.servers = []
+        self.clients = []
+
+        for i in range(3):
+            server = StandInNSMServer()
+            self.addCleanup(server.close)
+
+            with mock.patch.dict(os.environ, NSM_URL=server.url):
+                client = Client(name="client%i" % i, host=self.host,
+                                backend=BACKEND_UDP)
+
+            self.servers.append(server)
+            self.clients.append(client)
+
+    def test_dispatch(self):
+        self.assertEqual(self.host.clients, self.clients)
+        self.assertIsNotNone(self.host._thread)
+
+        for i, server in enumerate(self.servers):
+            server.request(MSG_OPEN, "/tmp/s%i" % i, "session", "n%i" % i)
+            server.request(MSG_SAVE)
+
+        for i, client in enumerate(self.clients):
+            self.assertFalse(client.threaded)
+            self.assertEqual(client.state.session_path, "/tmp/s%i/data" % i)
+            self.assertEqual(client.saved, ["/tmp/s%i/data" % i])
+
+    def test_close_client(self):
+        client = self.clients[1]
+        client.close()
+        self.assertTrue(client.quit_called)
+        self.assertEqual(self.host.clients,
+                         [self.clients[0], self.clients[2]])
+
+        # The other clients are still served
+        self.servers[2].request(MSG_SAVE)
+        self.assertEqual(len(self.clients[2].saved), 1)
+
+    def test_close(self):
+        thread = self.host._thread
+        self.host.close()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.host.clients, [])
+        self.assertTrue(all(client.quit_called for client in self.clients))
@@ -0,0 +1,92 @@
+"""Tests for the pure-Python OSC codec."""
+
+import unittest
+
+import nsmclient
+from nsmclient import (OSCMessageTemplate, decode_osc_message,
+                       encode_osc_bundle, encode_osc_message, iter_osc_packet)
+
+
+class TestMessageCodec(unittest.TestCase):
+    def assertRoundTrip(self, path, *args, typetags):
+        data = encode_osc_message(path, *args)
+        self.assertEqual(len(data) % 4, 0)
+        self.assertEqual(decode_osc_message(data), (path, list(args),
+                                                    typetags))
+
+    def test_no_arguments(self):
+        self.assertRoundTrip("/nsm/client/is_dirty", typetags="")
+
+    def test_numbers(self):
+        self.assertRoundTrip("/test", 1, -2, 2 ** 40, 0.5, typetags="iihf")
+
+    def test_strings(self):
+        self.assertRoundTrip("/test", "", "abc", "abcd", "grüße",
+                             typetags="ssss")
+
+    def test_blobs(self):
+        self.assertRoundTrip("/test", b"", b"\x00\x01\x02", b"abcd", 1,
+                             typetags="bbbi")
+
+    def test_special_values(self):
+        self.assertRoundTrip("/test", True, False, None, "x",
+                             typetags="TFNs")
+
+    def test_explicit_typetags(self):
+        data = encode_osc_message("/test", ('d', 0.1), ('c', 'x'), ('t', 1))
+        self.assertEqual(decode_osc_message(data),
+                         ("/test", [0.1, 'x', 1], "dct"))
+
+    def test_enum_arguments(self):
+        data = encode_osc_message(nsmclient.MSG_ERROR, nsmclient.MSG_OPEN,
+                                  nsmclient.ErrCode.BAD_PROJECT, "error")
+        self.assertEqual(decode_osc_message(data)[1],
+                         [nsmclient.MSG_OPEN,
+                          nsmclient.ErrCode.BAD_PROJECT.value, "error"])
+
+    def test_template(self):
+        template = OSCMessageTemplate(nsmclient.MSG_MESSAGE, "is")
+        self.assertEqual(template.encode(2, "Loading"),
+                         encode_osc_message(nsmclient.MSG_MESSAGE, 2,
+                                            "Loading"))
+
+    def test_uncached_template(self):
+        count = len(nsmclient._OSC_TEMPLATES)
+        encode_osc_message("/uncached/path", 1, cache=False)
+        self.assertEqual(len(nsmclient._OSC_TEMPLATES), count)
+
+    def test_unsupported_type(self):
+        with self.assertRaises(TypeError):
+            encode_osc_message("/test", object())
+
+
+class TestBundleCodec(unittest.TestCase):
+    messages = [
+        (nsmclient.MSG_PROGRESS, 0.5),
+        (nsmclient.MSG_DIRTY,),
+        (nsmclient.MSG_MESSAGE, 1, "Status"),
+    ]
+
+    def test_bundle_round_trip(self):
+        data = encode_osc_bundle(self.messages)
+        self.assertTrue(data.startswith(b"#bundle\0"))
+        self.assertEqual(
+            [(path,) + tuple(args) for path, args, _ in iter_osc_packet(data)],
+            self.messages)
+
+    def test_nested_bundle(self):
+        inner = encode_osc_bundle(self.messages[1:])
+        outer = encode_osc_bundle(self.messages[:1])
+        data = outer + b"".join([len(inner).to_bytes(4, 'big'), inner])
+        self.assertEqual(
+            [path for path, _, _ in iter_osc_packet(data)],
+            [msg[0] for msg in self.messages])
+
+    def test_single_message_packet(self):
+        data = encode_osc_message(*self.messages[2])
+        self.assertEqual(list(iter_osc_packet(data)),
+                         [(nsmclient.MSG_MESSAGE, [1, "Status"], "is")])
+
+
+if __name__ == '__main__':
+    unittest.main()
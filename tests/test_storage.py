@@ -0,0 +1,266 @@
+"""Tests for the session storage helpers in nsmclient_storage."""
+
+import json
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from os.path import join
+
+from nsmclient import NSMError
+from nsmclient_storage import (AssetPool, JournaledSessionStore, MappedFile,
+                               MappedRecordFile)
+
+
+class StorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        # Runs after the cleanups registered by tests
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def write(self, name, data):
+        path = join(self.tmpdir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path, 'wb') as fp:
+            fp.write(data)
+
+        return path
+
+
+def append_record(state, record):
+    return state + [record]
+
+
+class TestJournaledSessionStore(StorageTestCase):
+    def make_store(self, **kwargs):
+        store = JournaledSessionStore(None, append_record,
+                                      directory=self.tmpdir, **kwargs)
+        self.addCleanup(store.close)
+        return store
+
+    def reload(self):
+        return self.make_store().load(initial=[])
+
+    def journal(self, generation):
+        return join(self.tmpdir, JournaledSessionStore.JOURNAL % generation)
+
+    def test_load(self):
+        store = self.make_store()
+        self.assertEqual(store.load(initial=[]), [])
+        store.append(1)
+        store.append(2)
+        store.sync()
+        self.assertEqual(self.reload(), [1, 2])
+
+    def test_append_to_new_journal(self):
+        store = self.make_store()
+        store.load(initial=[])
+        store.append(1)
+        store.close()
+        store = self.make_store()
+        store.load(initial=[])
+        store.append(2)
+        store.close()
+        self.assertTrue(os.path.exists(self.journal(2)))
+        self.assertEqual(self.reload(), [1, 2])
+
+    def test_empty_journal_removed(self):
+        store = self.make_store()
+        store.load(initial=[])
+        store.close()
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_incomplete_record(self):
+        store = self.make_store()
+        store.load(initial=[])
+        store.append(1)
+        store.append(2)
+        store.close()
+
+        with open(self.journal(1), 'r+b') as fp:
+            fp.truncate(os.path.getsize(self.journal(1)) - 1)
+
+        with self.assertLogs("nsmclient_storage", "WARNING"):
+            self.assertEqual(self.reload(), [1])
+
+    def test_corrupt_record(self):
+        store = self.make_store()
+        store.load(initial=[])
+        store.append(1)
+        store.append(2)
+        store.close()
+
+        with open(self.journal(1), 'r+b') as fp:
+            fp.seek(-1, os.SEEK_END)
+            last = fp.read(1)
+            fp.seek(-1, os.SEEK_END)
+            fp.write(bytes([last[0] ^ 0xFF]))
+
+        with self.assertLogs("nsmclient_storage", "WARNING"):
+            self.assertEqual(self.reload(), [1])
+
+    def test_compact(self):
+        store = self.make_store()
+        store.load(initial=[])
+        store.append(1)
+        store.append(2)
+        store.compact()
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         [JournaledSessionStore.JOURNAL % 2,
+                          JournaledSessionStore.SNAPSHOT])
+        store.append(3)
+        store.close()
+        self.assertEqual(self.reload(), [1, 2, 3])
+
+    def test_background_compaction(self):
+        store = self.make_store(compact_threshold=1)
+        store.load(initial=[])
+        store.append(1)
+        store.wait()
+        store.append(2)
+        store.wait()
+        store.close()
+        self.assertTrue(os.path.exists(
+            join(self.tmpdir, JournaledSessionStore.SNAPSHOT)))
+        self.assertEqual(self.reload(), [1, 2])
+
+    def test_invalid_snapshot(self):
+        self.write(JournaledSessionStore.SNAPSHOT, b"x" * 32)
+
+        with self.assertRaises(NSMError):
+            self.reload()
+
+
+class TestAssetPool(StorageTestCase):
+    def setUp(self):
+        super().setUp()
+        self.pool = AssetPool(join(self.tmpdir, "pool"))
+
+    def test_add(self):
+        src = self.write("a.wav", b"sample data")
+        digest = self.pool.add(src)
+        self.assertEqual(self.pool.add(self.write("b.wav", b"sample data")),
+                         digest)
+
+        with open(self.pool.object_path(digest), 'rb') as fp:
+            self.assertEqual(fp.read(), b"sample data")
+
+    def test_materialize(self):
+        digest = self.pool.add(self.write("a.wav", b"sample data"))
+        dest = join(self.tmpdir, "session", "samples", "a.wav")
+        self.assertIn(self.pool.materialize(digest, dest),
+                      ('reflink', 'hardlink', 'copy'))
+        self.assertEqual(self.pool.materialize(digest, dest), 'unchanged')
+
+        with open(dest, 'rb') as fp:
+            self.assertEqual(fp.read(), b"sample data")
+
+    def test_materialize_copy(self):
+        pool = AssetPool(self.pool.directory, hardlinks=False)
+        digest = pool.add(self.write("a.wav", b"sample data"))
+        dest = join(self.tmpdir, "session", "a.wav")
+        self.assertIn(pool.materialize(digest, dest), ('reflink', 'copy'))
+        self.assertEqual(os.stat(dest).st_nlink, 1)
+
+    def test_materialize_unknown_digest(self):
+        with self.assertRaises(NSMError):
+            self.pool.materialize("00" * 32, join(self.tmpdir, "x.wav"))
+
+    def test_flush(self):
+        cache = join(self.pool.directory, "hashes.json")
+        src = self.write("a.wav", b"sample data")
+        gone = self.write("b.wav", b"other data")
+        self.pool.add(src)
+        self.pool.add(gone)
+        self.assertFalse(os.path.exists(cache))
+        os.unlink(gone)
+        self.pool.flush()
+
+        with open(cache) as fp:
+            self.assertEqual(list(json.load(fp)), [os.path.abspath(src)])
+
+        # The cached digest is used by a new pool instance
+        pool = AssetPool(self.pool.directory)
+        pool._hash = None
+        self.assertEqual(pool.hash_file(src), self.pool.hash_file(src))
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+class TestMappedFile(StorageTestCase):
+    def test_view(self):
+        data = struct.pack('<I3f', 3, 0.5, 1.0, 2.0)
+
+        with MappedFile(self.write("data.bin", data)) as mapped:
+            self.assertEqual(len(mapped), len(data))
+            self.assertEqual(mapped.view.tobytes(), data)
+            self.assertEqual(mapped.unpack('<I'), (3,))
+            self.assertEqual(mapped.unpack(struct.Struct('<f'), 8), (1.0,))
+            samples = mapped.cast('f', 4)
+            self.assertEqual(samples.tolist(), [0.5, 1.0, 2.0])
+            self.assertEqual(mapped.cast('f', 4, count=1).tolist(), [0.5])
+            samples.release()
+
+    def test_empty(self):
+        with MappedFile(self.write("empty.bin", b"")) as mapped:
+            self.assertEqual(len(mapped), 0)
+            self.assertEqual(mapped.cast('f').tolist(), [])
+
+    def test_close_with_exported_view(self):
+        mapped = MappedFile(self.write("data.bin", b"\0" * 8))
+        samples = mapped.cast('f')
+
+        with self.assertRaises(BufferError):
+            mapped.close()
+
+        samples.release()
+        mapped.close()
+
+
+class TestMappedRecordFile(StorageTestCase):
+    def test_create(self):
+        path = join(self.tmpdir, "voices.bin")
+
+        with MappedRecordFile(path, '<if', count=4,
+                              fields=('note', 'gain')) as voices:
+            self.assertEqual(len(voices), 4)
+            voices[1] = (60, 0.5)
+            voices[-1] = (72, 0.25)
+            self.assertEqual(voices[1].note, 60)
+            self.assertEqual(voices[3], (72, 0.25))
+
+        self.assertEqual(os.path.getsize(path), 4 * 8)
+
+        with MappedRecordFile(path, '<if') as voices:
+            self.assertEqual(list(voices),
+                             [(0, 0.0), (60, 0.5), (0, 0.0), (72, 0.25)])
+
+    def test_index_error(self):
+        with MappedRecordFile(join(self.tmpdir, "r.bin"), '<i',
+                              count=2) as records:
+            self.assertRaises(IndexError, records.__getitem__, 2)
+            self.assertRaises(IndexError, records.__setitem__, -3, (1,))
+
+    def test_resize(self):
+        path = join(self.tmpdir, "r.bin")
+
+        with MappedRecordFile(path, '<i', count=2) as records:
+            records[1] = (5,)
+            records.resize(3)
+            records[2] = (7,)
+            self.assertEqual(list(records), [(0,), (5,), (7,)])
+            records.resize(0)
+            self.assertEqual(list(records), [])
+
+        self.assertEqual(os.path.getsize(path), 0)
+
+    def test_invalid_size(self):
+        path = self.write("r.bin", b"\0" * 5)
+
+        with self.assertRaises(ValueError):
+            MappedRecordFile(path, '<i')